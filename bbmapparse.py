@@ -1,94 +1,119 @@
 import argparse
 import sys
 
+import samio
+from lineageindex import LineageIndex
+
 parser = argparse.ArgumentParser(description="Takes bbmap results and reports taxonomic classifications. Takes queries of things you want to be in the string as well as things you don't want to be in the string. Summarizes stats.")
 
-parser.add_argument("-i", "--input", help="path to input file")
-parser.add_argument("--test", help="string to test for in reads; if in string, it's reported; separate multiple queries with a single comma ','")
+parser.add_argument("-i", "--input", help="path to input .sam file (may be gzip or bgzip compressed, or BAM)")
+parser.add_argument("--test", help="string to test for in reads; if in string, it's reported; separate multiple queries with a single comma ','. \
+'=Name' only matches a level named exactly Name, and 'N=Name' only a level named Name at rank N (domain is rank 0), e.g. --test 1=Fungi")
 parser.add_argument("--untest", help="string to test against in reads; if in string, don't report even if --test arg is also in string ; separate multiple queries with a single comma ','")
 parser.add_argument("--nolsu", default="False", help="Ignore LSU results. Default false.")
 parser.add_argument("--nossu", default="False", help="Ignore SSU results. Default False.")
 parser.add_argument("--reportnum", default=50, help="Number of reads to report before stopping. Default 50.")
+parser.add_argument("--queries", help="file of many queries to run in one pass over the input, one per line: <name><tab><test strings><tab><untest strings>, \
+with the test and untest strings comma separated like --test/--untest (including the '=Name' and 'N=Name' forms) (untest can be left out). Reports the number of matching reads and up to --reportnum example reads per query. Replaces --test/--untest")
 
 
-args = parser.parse_args()
-infile = args.input
-teststr = args.test
-try:
-	teststrings = teststr.split(",")
-except:
-	teststrings = False
-unteststr = args.untest
-try:
-	unteststrings = unteststr.split(",")
-except:
-	unteststrings = False
-if args.nolsu.lower() == "true" or args.nolsu.lower() == "t":
-	ilsu = True
-else:
-	ilsu = False
-if args.nossu.lower() == "true" or args.nossu.lower() == "t":
-	issu = True
-else:
-	issu = False
-teststop = int(args.reportnum)
+###
+#Matching goes through lineageindex.LineageIndex: every distinct reference name is parsed and checked against every query once,
+#and every read after that is a dict lookup. Terms can be substrings (as always), "=Name" for a level named exactly Name,
+#or "N=Name" for Name at rank N (domain is 0). Query file mode evaluates any number of queries in the same single pass.
+###
 
-inf = open(infile, "r")
-total = 0
-rnatotal = 0
-lsutotal = 0
-ssutotal = 0
-testtot = 0
+def readqueries(path):
+	queries = []
+	inf = open(path, "r")
+	for line in inf:
+		if not line.strip() or line.startswith("#"):
+			continue
+		fields = line.rstrip("\n").split("\t")
+		if len(fields) < 2:
+			print("query lines must be <name><tab><test terms>[<tab><untest terms>]: " + line.rstrip("\n"))
+			sys.exit(1)
+		tests = [item for item in fields[1].split(",") if item]
+		untests = [item for item in fields[2].split(",") if item] if len(fields) > 2 else []
+		queries.append((fields[0], tests, untests))
+	inf.close()
+	return queries
 
-print('Search string: "%s" ; Unsearch string: "%s" ; Ignore LSU: "%s" ; Ignore SSU: "%s"' % (teststrings, unteststrings, str(ilsu), str(issu)))
-for line in inf:
-	report = True
-	if testtot >= teststop:
-		report = False
-	if line.startswith( "@" ) or line == "\n":
-		continue
-	else:
-		total += 1
+def runqueries(infile, queries, ilsu, issu, reportnum):
+	index = LineageIndex([(tests, untests) for name, tests, untests in queries])
+	totals = {"reads": 0, "rRNA": 0, "LSU": 0, "SSU": 0}
+	counts = [{"LSU": 0, "SSU": 0, "total": 0} for query in queries]
+	examples = [[] for query in queries]
+	for line in samio.records(infile):    # bytes, starting after the @SQ header; only new reference names get decoded
+		if line.startswith( b"@" ) or line == b"\n":
+			continue
+		totals["reads"] += 1
 		try:
-			region = line.split("\t")[2]
+			region = samio.refName(line)
 		except:
-			print(line)
+			print(line.decode(errors="replace"))
 			exit(1)
-		if ";" not in region:
+		rna, taxa, levels, matches = index.lookup(region)
+		if taxa is None:
+			continue
+		totals["rRNA"] += 1
+		if rna == "LSU" and ilsu or rna == "SSU" and issu:
 			continue
-		rnatotal += 1
-		if "LSU" in region:
-			if ilsu == True:
-				continue
-			rna = "LSU"
-			lsutotal += 1
-		elif "SSU" in region:
-			if issu == True:
-				continue
-			rna = "SSU"
-			ssutotal += 1
-		parts = region.split()
-		taxa = " ".join(parts[1:])
+		if rna is not None:
+			totals[rna] += 1
+		for i in matches:
+			counts[i]["total"] += 1
+			if rna is not None:
+				counts[i][rna] += 1
+			if len(examples[i]) < reportnum:
+				examples[i].append(str(rna) + "\t" + taxa)
+	return totals, counts, examples
 
-		test = True
-		untest = True
+def writequeries(outf, queries, totals, counts, examples):
+	outf.write("Total reads: %d\nTotal rRNA: %d\nTotal LSU: %d\nTotal SSU:  %d\n\n" % (totals["reads"], totals["rRNA"], totals["LSU"], totals["SSU"]))
+	outf.write("query\tLSU\tSSU\ttotal\tpercent of rRNA\n")
+	for (name, tests, untests), count in zip(queries, counts):
+		percent = round(count["total"] / totals["rRNA"] * 100, 3) if totals["rRNA"] else 0
+		outf.write("%s\t%d\t%d\t%d\t%s\n" % (name, count["LSU"], count["SSU"], count["total"], percent))
+	for (name, tests, untests), hits in zip(queries, examples):
+		outf.write('\n== %s: test "%s" ; untest "%s" ==\n' % (name, ",".join(tests), ",".join(untests)))
+		for hit in hits:
+			outf.write(hit + "\n")
+
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+	infile = args.input
+	teststr = args.test
+	try:
+		teststrings = teststr.split(",")
+	except:
+		teststrings = False
+	unteststr = args.untest
+	try:
+		unteststrings = unteststr.split(",")
+	except:
+		unteststrings = False
+	if args.nolsu.lower() == "true" or args.nolsu.lower() == "t":
+		ilsu = True
+	else:
+		ilsu = False
+	if args.nossu.lower() == "true" or args.nossu.lower() == "t":
+		issu = True
+	else:
+		issu = False
+	teststop = int(args.reportnum)
 
-		if teststrings == False:
-			pass
-		else:
-			for item in teststrings:
-				if item not in taxa:   # If ANY of the test strings aren't there, test fails.
-					test = False
-		if unteststrings == False:
-			pass
-		else:
-			for item in unteststrings:
-				if item in taxa:       # If ANY of the test strings are there, untest fails.
-					untest = False
+	if args.queries:
+		queries = readqueries(args.queries)
+		print('Queries: %d from "%s" ; Ignore LSU: "%s" ; Ignore SSU: "%s"\n' % (len(queries), args.queries, str(ilsu), str(issu)))
+		totals, counts, examples = runqueries(infile, queries, ilsu, issu, teststop)
+		writequeries(sys.stdout, queries, totals, counts, examples)
+		sys.exit(0)
 
-		if test == True and untest == True:    # If all test and no untest present, counter increments.
-			if report == True:
-				print(rna + "\t" + taxa)
-			testtot += 1
+	print('Search string: "%s" ; Unsearch string: "%s" ; Ignore LSU: "%s" ; Ignore SSU: "%s"' % (teststrings, unteststrings, str(ilsu), str(issu)))
+	totals, counts, examples = runqueries(infile, [("match", teststrings or [], unteststrings or [])], ilsu, issu, teststop)
+	for hit in examples[0]:
+		print(hit)
 
-print("Total reads: %d\nTotal rRNA: %d\nTotal LSU: %d\nTotal SSU:  %d\nTotal match: %d\n" % (total, rnatotal, lsutotal, ssutotal, testtot))
+	print("Total reads: %d\nTotal rRNA: %d\nTotal LSU: %d\nTotal SSU:  %d\nTotal match: %d\n" % (totals["reads"], totals["rRNA"], totals["LSU"], totals["SSU"], counts[0]["total"]))
@@ -2,19 +2,36 @@ import argparse
 import sys
 import os
 import logging
+import multiprocessing
+import pickle
+
+import compressedio
+import samio
+from taxtrie import TaxTrie
+from kronahtml import writeKrona
+from taxcache import TaxCache
+from samplematrix import runBatch, writeMatrix
+from refcache import ReferenceCache, defaultSize
 
 def parser_gen():
     parser = argparse.ArgumentParser(
         description="""Takes output of bbmap mapping a metagenome
         to silva database and parses the data to generate a taxonomic summary.
-        Requires Python 3 and krona perl module in PATH.""",
+        Requires Python 3. Krona charts are written directly, so Krona itself doesn't need to be installed.""",
         epilog="""Example command: bbmaptax.py -i example.txt"""
         )
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
+        "-i", "--input", dest='infile',
+        help="""path to input file, or '-' to read the .sam from stdin (e.g. piped straight out of bbmap.sh).
+        gzip, bgzip and BAM files are read as they are, no need to decompress them first.""")
+    inputs.add_argument(
+        "--manifest", dest='manifest',
+        help="""Batch mode: tab-separated file of <sample name>\t<path to .sam>, one sample per line.
+        Samples are processed --threads at a time, each writing its own <output>.<sample>.* files,
+        plus a combined <output>.taxmatrix.txt of counts for every taxon in every sample.""")
     parser.add_argument(
-        "-i", "--input", dest='infile', required=True
-        help="path to input file")
-    parser.add_argument(
-        "-o", "--output", dest='outbase', default='metatax'
+        "-o", "--output", dest='outbase', default='metatax',
         help="output base name")
     parser.add_argument(
         "--filter", type=float, dest='filter', default=0.2, 
@@ -24,23 +41,66 @@ def parser_gen():
     parser.add_argument(
         "--krona", dest='krona', default="True", 
         help="If True, will generate an interactive chrona chart from data.")
+    parser.add_argument(
+        "--kronabundle", dest='kronabundle', default="False",
+        help="""If True, the merged, ssu and lsu krona charts are written as three datasets
+        of a single <output>.krona.html instead of three separate html files.""")
+    parser.add_argument(
+        "--kronaurl", dest='kronaurl', default=None,
+        help="""Where the krona charts load the Krona javascript and images from. The charts aren't self-contained:
+        by default they load them from the Krona website (or $KRONA_URL), so they need internet access to render.
+        Give the path or URL of a local Krona install (the directory holding src/ and img/) to view them offline.""")
+    parser.add_argument(
+        "--counts", dest='counts', default="False",
+        help="""If True, also writes the raw counts as a binary table in <output>.counts/
+        (NumPy .npy files that can be memory-mapped and combined across samples, see taxcounts.py). Requires NumPy.""")
+    parser.add_argument(
+        "--merge", dest='merge', default="matched", choices=["matched", "union"],
+        help="""How to merge LSU and SSU. 'matched' (default) only reports taxa found in both;
+        'union' also keeps sizable taxa that are only in one of the two, tagged as such.""")
+    parser.add_argument(
+        "--checkpoint", type=int, dest='checkpoint', default=0,
+        help="""Save the counts so far and how far into the input they go to the --state file
+        every <checkpoint> lines, so a killed run can pick up where it left off with --resume.
+        Default 0 (no checkpoints). Reads the input on one process.""")
+    parser.add_argument(
+        "--state", dest='state', default=None,
+        help="State file used by --checkpoint and --resume. Default <output>.state")
+    parser.add_argument(
+        "--resume", dest='resume', default="False",
+        help="""If True, starts from the counts in the --state file and only reads the input from where
+        that state left off. An input the state hasn't seen yet (e.g. a new chunk of the same library)
+        is read from the start and added to the saved counts, so old reads are never counted again.""")
+    parser.add_argument(
+        "--cache", dest='cache', default=None,
+        help="""Directory to cache parsed counts in. Re-running on the same input (e.g. to change --filter
+        or krona options) then skips parsing. Entries are keyed by the input's contents.""")
+    parser.add_argument(
+        "--cachesize", type=float, dest='cachesize', default=1024,
+        help="Size limit of the --cache directory in MB; least recently used entries are removed past it. Default 1024.")
+    parser.add_argument(
+        "--threads", type=int, dest='threads', default=1,
+        help="""Number of processes used to parse the .sam. The file is split into
+        line-aligned chunks that are counted in parallel. Ignored when reading from stdin.
+        bgzip and BAM inputs are instead decompressed on this many threads (up to 4 by default).
+        In batch mode, the number of samples processed at once.""")
+    parser.add_argument(
+        "--refcache", type=int, dest='refcache', default=defaultSize,
+        help="""Most reference names to keep parsed at once. Each reference's rRNA type and lineage is parsed
+        the first time it's needed, and looked up after that (see refcache.py). With --engine twophase it's also
+        the most reference names counted before their reads are added to the totals. Default %d.""" % defaultSize)
+    parser.add_argument(
+        "--preload", dest='preload', default="False",
+        help="""If True, parses every reference of the @SQ header up front, so counting the reads
+        is all lookups. Only worth it with --engine legacy, when most references in the header get reads. Not done for stdin.""")
+    parser.add_argument(
+        "--engine", dest='engine', default="twophase", choices=["twophase", "legacy"],
+        help="""How reads are counted. 'twophase' (default) counts the reads of each reference name,
+        then adds each reference's lineage to the counts once, weighted by its reads.
+        'legacy' adds the lineage of every read as it comes, for comparison. Both give the same counts.""")
     args = parser.parse_args()
     return args
 
-total = 0
-lsuTotal = 0
-ssuTotal = 0
-lsuCategories = dict()
-ssuCategories = dict()
-sortedLsuCategories = dict()
-sortedSsuCategories = dict()
-
-taxOut = outbase + ".taxstats.txt"
-kronaOut = outbase + ".krona.txt"
-
-inf = open(infile, "r")
-taxOutf = open(taxOut, "w+")
-
 """
  I wish I could do something a bit more sophisticated with the colors, but the terminal doesn't support truecolor,
  so any option that uses (r,g,b) doesn't work. 
@@ -69,70 +129,195 @@ def makeColor(percent):
         color = '\033[38;5;196m'
     return color
 
-""" 
- Takes the bbmap .sam output and summarizes results by taxonomic level 
 """
-def TaxParser():
-    global total      # This is probably the most embarrassing part of this script.
-    global lsuTotal   # I need the totals and dictionaries in other functions, so I just make them global.
-    global ssuTotal
-    for line in inf:
+Accumulates LSU/SSU taxonomy counts from bbmap .sam lines.
+Lines can come from any iterable (an open file, sys.stdin piped out of bbmap.sh, a list...),
+so the .sam never has to be written to disk. Memory grows with the number of distinct categories, not reads.
+Reference names are parsed once each and looked up after that (see refcache.py).
+
+With the default twophase engine, reads are first only counted per raw reference name (pending),
+and each name's lineage is added to the tries once, weighted by its reads, when the counts are flushed.
+Anything reading the totals or the tries has to flush first; consume, merge and pickling do it themselves.
+"""
+class TaxonomyAggregator:
+    def __init__(self, references=None, engine="twophase"):
+        self.total = 0
+        self.lsuTotal = 0
+        self.ssuTotal = 0
+        self.lsuTrie = TaxTrie()
+        self.ssuTrie = TaxTrie()
+        self.references = references if references is not None else ReferenceCache()
+        self.engine = engine
+        self.pending = dict()    # reference name -> reads not added to the tries yet
+        self.categoryMemo = dict()    # the categories (and their sorted keys) built since the tries last changed
+
+    def __getstate__(self):
+        self.flush()
+        state = dict(self.__dict__)
+        state["categoryMemo"] = dict()
+        return state
+
+    def addLine(self, line):
         if line.startswith( "@" ) or line == "\n":  # .sam files include many non-read lines that start with '@' (including the entire reference database), or empty lines. Want to ignore these.
-            continue
+            return
+        self.total += 1
+        idRegion=line.split('\t')[2] # read lines are reported as follows: [readID]\t[score]\t[taxID]\t[lots of other things separated by more tabs]. We want the taxID ragion.
+        self.addRef(idRegion)
+
+    """Same as addLine, for a record read as bytes (see samio.py). Only new reference names get decoded."""
+    def addRecord(self, record):
+        if record.startswith(b"@") or record == b"\n":
+            return
+        self.total += 1
+        self.addRef(record.split(b"\t", 3)[2])
+
+    """Counts one read mapped to the reference named idRegion (e.g. 'tid|1234|LSU Eukaryota;Fungi;...', as str or bytes)"""
+    def addRef(self, idRegion):
+        if self.engine == "legacy":
+            self.addLineage(idRegion, 1)
+            return
+        reads = self.pending.get(idRegion)
+        if reads is None:
+            if len(self.pending) >= self.references.maxSize:    # keeps pending as bounded as the reference cache
+                self.flush()
+            self.pending[idRegion] = 1
         else:
-            total += 1
-            idRegion=line.split('\t')[2] # read lines are reported as follows: [readID]\t[score]\t[taxID]\t[lots of other things separated by more tabs]. We want the taxID ragion.
-            if "tid" not in idRegion:    # taxonomic classifications start with 'tid'. If no classification, it just moves on.
-                continue
-            if "LSU" in idRegion:
-                rna = "LSU"
-                lsuTotal += 1
-            if "SSU" in idRegion:
-                rna = "SSU"
-                ssuTotal += 1
-            parts=idRegion.split()       # idregion has two parts. the taxid and rRNA type separated by '|'s, then the tax classification separated by ';'s
-            taxa = ' '.join(parts[1:])   # Annoyingly, these parts are separated by spaces even though there are spaces in the tax classification.
-            taxaList = taxa.split(";")   # So, need to just remove everything before the first space to get the full tax list.
-
-            for i in range(1,len(taxaList)+1):      # Want Eukaryota, Eukaryota;Fungi, Eukaryota;Fungi;Dikarya, etc to have different categories to be able to count broader tax levels effectively.
-                fullName = ';'.join(taxaList[0:i])  # e.g. if function sees Eukaryota;Fungi and Eukaryota;Chloroplastida, I want "Eukaryota" to go up by 2 and the two kingdoms to go up 1 each.
-                levelName = taxaList[i-1]           # Having the FULL classification rather than just the last name is important for sorting and reporting later. Hence fullName as well as levelName.
-                if rna == "LSU":
-                    if fullName not in lsuCategories:
-                        lsuCategories[fullName] = [1, levelName]
-                    else:
-                        lsuCategories[fullName][0] += 1
-                if rna == "SSU":
-                    if fullName not in ssuCategories:
-                        ssuCategories[fullName] = [1, levelName]
-                    else:
-                        ssuCategories[fullName][0] += 1
-
-    global sortedLsu
-    sortedLsu=sorted(lsuCategories)
-    global sortedSsu
-    sortedSsu=sorted(ssuCategories)
-    lsuPct = round(lsuTotal / total * 100, 2)
-    ssuPct = round(ssuTotal / total * 100, 2)
-
-    taxOutf.write("\nTotal LSU rRNA: " + str(lsuTotal) + " (" + str(lsuPct) + "% of reads)\n\n")
-    for category in sortedLsu:
-            tabs = category.count(';')
-            number = lsuCategories[category][0]
-            name = lsuCategories[category][1]
-            percentage = round(number / lsuTotal * 100 , 2)
-            color = makeColor(percentage)
-            
-            if name != "" and percentage >= filter or tabs == 0:
-                    taxOutf.write(color + "    "*tabs + name + ": " + str(number) + " (" + str(percentage) + "% of rRNA)\n" + reset)
-    taxOutf.write("\n" + "-"*50 + "\n")
+            self.pending[idRegion] = reads + 1
+
+    """Adds reads reads of the reference named idRegion to the totals and the tries"""
+    def addLineage(self, idRegion, reads):
+        classified = self.references.lookup(idRegion)
+        if classified is None:    # no taxonomic classification, or neither LSU nor SSU
+            return
+        rna, taxaList = classified
+        if rna == "LSU":
+            trie = self.lsuTrie
+            self.lsuTotal += reads
+        else:
+            trie = self.ssuTrie
+            self.ssuTotal += reads
+
+        # Want Eukaryota, Eukaryota;Fungi, Eukaryota;Fungi;Dikarya, etc to have different categories to be able to count broader tax levels effectively.
+        # e.g. if function sees Eukaryota;Fungi and Eukaryota;Chloroplastida, I want "Eukaryota" to go up by 2 and the two kingdoms to go up 1 each.
+        # The trie does this by counting every node on the way down the lineage.
+        trie.add(taxaList, reads)
+        if self.categoryMemo:
+            self.categoryMemo.clear()
+
+    """Adds the pending per-reference counts to the totals and the tries"""
+    def flush(self):
+        for idRegion, reads in self.pending.items():
+            self.addLineage(idRegion, reads)
+        self.pending.clear()
+        return self
+
+    def consume(self, lines):
+        for line in lines:
+            self.addLine(line)
+        return self.flush()
+
+    def consumeRecords(self, records):
+        for record in records:
+            self.addRecord(record)
+        return self.flush()
+
+    """Adds the counts of another aggregator (e.g. from another shard of the same file) into this one"""
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.total += other.total
+        self.lsuTotal += other.lsuTotal
+        self.ssuTotal += other.ssuTotal
+        self.lsuTrie.merge(other.lsuTrie)
+        self.ssuTrie.merge(other.ssuTrie)
+        self.categoryMemo.clear()
+        self.references.mergeStats(other.references)
+        return self
+
+    """build() the first time key is asked for after the tries last changed, the same object after that"""
+    def memoized(self, key, build):
+        value = self.categoryMemo.get(key)
+        if value is None:
+            value = self.categoryMemo[key] = build()
+        return value
+
+    # Having the FULL classification rather than just the last name is important for sorting and reporting later.
+    # Hence these are {fullName: [count, levelName]}, built from the tries when first asked for and shared after that,
+    # so the reports, merges and krona charts all read the same dicts. Don't modify them.
+    @property
+    def lsuCategories(self):
+        return self.memoized("LSU", lambda: self.lsuTrie.categories(";"))
+
+    @property
+    def ssuCategories(self):
+        return self.memoized("SSU", lambda: self.ssuTrie.categories(";"))
+
+    def sortedLsu(self):
+        return self.memoized("sorted LSU", lambda: sorted(self.lsuCategories))
+
+    def sortedSsu(self):
+        return self.memoized("sorted SSU", lambda: sorted(self.ssuCategories))
+
+
+"""
+Splits a file into at most nShards byte ranges [start, end) that all begin at the start of a line,
+so every line of the file is read by exactly one shard.
+"""
+def shardRanges(path, nShards):
+    size = os.path.getsize(path)
+    bounds = [samio.headerEnd(path)]
+    with open(path, "rb") as f:
+        for i in range(1, nShards):
+            f.seek(max(size * i // nShards - 1, bounds[-1]))
+            f.readline()    # move up to the start of the next line
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(bounds[i], bounds[i+1]) for i in range(nShards) if bounds[i] < bounds[i+1]]
+
+"""Reference cache for counting a .sam file, with the names of its @SQ header already parsed if preload"""
+def referenceCache(infile, refCacheSize=defaultSize, preload=False):
+    references = ReferenceCache(refCacheSize)
+    if preload:
+        references.preload(samio.headerReferences(infile))
+    return references
+
+"""Counts the lines of one shard. Run in a worker process, so it takes a single (path, start, end, refCacheSize, preload, engine) tuple."""
+def countShard(shard):
+    path, start, end, refCacheSize, preload, engine = shard
+    aggregator = TaxonomyAggregator(referenceCache(path, refCacheSize, preload), engine)
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            aggregator.addRecord(line)
+    return aggregator.flush()
+
+"""
+Counts a .sam file on several cores: the file is split into line-aligned byte ranges,
+each range is counted in its own process, and the partial counts are added back together.
+Gives exactly the same counts as reading the file in one go.
+"""
+def parallelCount(path, threads, refCacheSize=defaultSize, preload=False, engine="twophase"):
+    shards = [(path, start, end, refCacheSize, preload, engine) for start, end in shardRanges(path, threads)]
+    aggregator = TaxonomyAggregator(ReferenceCache(refCacheSize), engine)
+    with multiprocessing.Pool(threads) as pool:
+        for partial in pool.imap_unordered(countShard, shards):
+            aggregator.merge(partial)
+    return aggregator
 
-    taxOutf.write("\nTotal SSU rRNA: " + str(ssuTotal) + " (" + str(ssuPct) + "% of reads)\n\n")
-    for category in sortedSsu:
+
+"""Writes the summary of one rRNA type, one line per category, indented by taxonomic level"""
+def writeReport(taxOutf, rna, categories, sortedKeys, typeTotal, total, filter):
+    typePct = round(typeTotal / total * 100, 2)
+    taxOutf.write("\nTotal " + rna + " rRNA: " + str(typeTotal) + " (" + str(typePct) + "% of reads)\n\n")
+    for category in sortedKeys:
             tabs = category.count(';')
-            number = ssuCategories[category][0]
-            name = ssuCategories[category][1]
-            percentage = round(number / ssuTotal * 100 , 2)
+            number = categories[category][0]
+            name = categories[category][1]
+            percentage = round(number / typeTotal * 100 , 2)
             color = makeColor(percentage)
 
             if name != "" and percentage >= filter or tabs == 0:
@@ -140,6 +325,121 @@ def TaxParser():
     taxOutf.write("\n" + "-"*50 + "\n")
 
 
+"""
+Checkpoint state is the aggregator plus, for every input file it has read, the byte offset it has read up to.
+It's written to a temporary file and renamed over the old one, so dying mid-save still leaves the previous checkpoint.
+"""
+def saveState(statePath, aggregator, offsets):
+    with open(statePath + ".tmp", "wb") as stateOutf:
+        pickle.dump({"aggregator": aggregator, "offsets": offsets}, stateOutf)
+    os.replace(statePath + ".tmp", statePath)
+
+def loadState(statePath):
+    with open(statePath, "rb") as stateInf:
+        state = pickle.load(stateInf)
+    return state["aggregator"], state["offsets"]
+
+"""
+Counts a .sam file, saving a checkpoint every interval lines (and once at the end).
+With resume, counting continues from the saved state: the file is read from the offset
+recorded for it, or from the start if the state hasn't seen this file before.
+"""
+def checkpointedCount(infile, statePath, interval, resume, references=None, engine="twophase"):
+    if resume and os.path.exists(statePath):
+        aggregator, offsets = loadState(statePath)
+        if references is not None:
+            aggregator.references = references.mergeStats(aggregator.references)
+        aggregator.engine = engine
+    else:
+        aggregator, offsets = TaxonomyAggregator(references, engine), dict()
+    key = os.path.realpath(infile)
+    offset = offsets.get(key, 0)
+    inf, compressed = compressedio.openDetected(infile)
+    seekable = not compressed and not compressedio.isStream(infile)
+    if seekable and offset > os.path.getsize(infile):
+        print("%s is smaller than when %s was saved, it can't be resumed." % (infile, statePath))
+        sys.exit(1)
+    if offset > 0:
+        print("Resuming from byte %d..." % offset)
+    elif seekable:
+        offset = samio.headerEnd(infile)
+    # Offsets into compressed files and pipes count the bytes read, so resuming one means reading up to there again
+    # (the header lines are then skipped by addRecord).
+    with inf:
+        if not seekable:
+            compressedio.skipBytes(inf, offset)
+        else:
+            inf.seek(offset)
+        lines = 0
+        for line in inf:
+            offset += len(line)
+            aggregator.addRecord(line)
+            lines += 1
+            if interval and lines % interval == 0:
+                offsets[key] = offset
+                saveState(statePath, aggregator, offsets)
+    offsets[key] = offset
+    saveState(statePath, aggregator, offsets)    # (pickling flushes the pending counts)
+    return aggregator
+
+
+# Bump when the way reads are counted changes, so cached counts from before aren't reused.
+cacheNamespace = "bbmaptax-1"
+
+""" 
+ Takes the bbmap .sam output and summarizes results by taxonomic level 
+"""
+def TaxParser(infile, taxOutf, filter, threads=1, statePath=None, interval=0, resume=False, cache=None, refCacheSize=defaultSize, preload=False,
+              engine="twophase"):
+    counted = True
+    if infile == "-":
+        aggregator = TaxonomyAggregator(ReferenceCache(refCacheSize), engine).consumeRecords(samio.records("-"))
+    elif statePath and (interval or resume):
+        aggregator = checkpointedCount(infile, statePath, interval, resume, referenceCache(infile, refCacheSize, preload), engine)
+    else:
+        aggregator = None
+        if cache:
+            aggregator = cache.get(infile, cacheNamespace)
+        if aggregator is None:
+            if threads > 1 and not compressedio.isStream(infile) and not compressedio.isCompressed(infile):
+                aggregator = parallelCount(infile, threads, refCacheSize, preload, engine)
+            else:    # compressed files can't be split up, but BGZF and BAM are decompressed on all the threads instead
+                aggregator = TaxonomyAggregator(referenceCache(infile, refCacheSize, preload), engine)
+                aggregator.consumeRecords(samio.records(infile, threads if threads > 1 else None))
+            if cache:
+                cache.put(infile, cacheNamespace, aggregator)
+        else:
+            counted = False
+            print("Using cached counts for " + infile)
+    # twophase only looks each reference up once, so its hit rate says nothing about the reads
+    if counted and engine == "legacy":
+        print(aggregator.references.summary())
+    lsuCategories = aggregator.lsuCategories
+    ssuCategories = aggregator.ssuCategories
+    writeReport(taxOutf, "LSU", lsuCategories, aggregator.sortedLsu(), aggregator.lsuTotal, aggregator.total, filter)
+    writeReport(taxOutf, "SSU", ssuCategories, aggregator.sortedSsu(), aggregator.ssuTotal, aggregator.total, filter)
+    return aggregator
+
+
+"""
+Builds a lookup from (domain, level name) to the first category with that name in sortedKeys.
+Sorting puts broader ranks before the more specific ones under them, so the first hit is the broadest match.
+Categories making up less than minPct percent of typeTotal are left out of the index,
+so a later (more specific) category with the same name can still be picked up.
+This lets the merges below do one dict lookup per LSU category instead of scanning all of SSU.
+"""
+def mergeIndex(categories, sortedKeys, typeTotal, minPct):
+    index = dict()
+    for item in sortedKeys:
+        name = categories[item][1]
+        key = (item.split(";", 1)[0], name)
+        if key in index:
+            continue
+        if round(categories[item][0] / typeTotal * 100, 4) >= minPct:
+            index[key] = item
+    return index
+
+
 """
 Takes the results of lsu and ssu parsing and merges them, where possible
 NOTE: this will only report taxa that are present in BOTH LSU and SSU
@@ -147,49 +447,42 @@ i.e. even if something is 20% of LSU, if it's not in SSU at all it isn't reporte
 This is why the program also produces LSU and SSU results separately.
 See function below for why it's not good to just add together LSU and SSU and why it HAS to be only matches
 """
-
-
-def rRNA_Merge(reportfilter):
-    global mergedCategories
+def rRNA_Merge(aggregator, taxOutf, reportfilter):
+    lsuCategories = aggregator.lsuCategories
+    ssuCategories = aggregator.ssuCategories
+    lsuTotal = aggregator.lsuTotal
     mergedCategories = dict()
-    global mergedTotal
-    mergedTotal = lsuTotal + ssuTotal
-    mergedPct = round(mergedTotal/total * 100, 2)
+    mergedTotal = aggregator.lsuTotal + aggregator.ssuTotal
+    mergedPct = round(mergedTotal/aggregator.total * 100, 2)
     taxOutf.write("\nTotal rRNA: " + str(mergedTotal) + " (" + str(mergedPct) + "% of reads)\n\n")
     rfil = reportfilter
     includefilter = 0.01
-    
-    for lItem in sortedLsu:
-        lDomain = lItem.split(";")[0]
+    ssuIndex = mergeIndex(ssuCategories, aggregator.sortedSsu(), aggregator.ssuTotal, includefilter)
+
+    for lItem in aggregator.sortedLsu():
+        lDomain = lItem.split(";", 1)[0]
         lName = lsuCategories[lItem][1]
         lNumber = lsuCategories[lItem][0]
         lPct = round(lNumber / lsuTotal * 100, 4)
-        match = False
+        if lPct < includefilter:
+            continue
 
-        # First, see if lItem matches with anything in SSU. If it does, add counts together and append to merged dict.
-        for sItem in sortedSsu:
-            sDomain = sItem.split(";")[0]
-            sName = ssuCategories[sItem][1]
-            sNumber = ssuCategories[sItem][0]
-            sPct = round(sNumber / ssuTotal * 100, 4)
-             
-            if sName == lName and sDomain == lDomain and lPct >= includefilter and sPct >= includefilter:
-                match = True
-                mergedNumber = sNumber + lNumber
-                mergedPct = round(mergedNumber / mergedTotal * 100, 2)
-                mergedCategories[lItem] = [mergedNumber, lName]
-                color = makeColor(mergedPct)
-                if sName != "" and lName != "" and mergedPct >= rfil or sDomain == sName:
-                    tabs = lItem.count(';')
-                    taxOutf.write(color + "    "*tabs + lName + ": " + str(mergedNumber) + " (" + str(mergedPct) + "% of rRNA)\n" + reset)
-                
-            if match == True:  #If match already occurred, no reason to keep searching. Move on.
-                break
-    global sortedMerged
-    sortedMerged = sorted(mergedCategories)
+        # See if lItem matches with anything in SSU. If it does, add counts together and append to merged dict.
+        sItem = ssuIndex.get((lDomain, lName))
+        if sItem is None:
+            continue
+        sName = ssuCategories[sItem][1]
+        mergedNumber = ssuCategories[sItem][0] + lNumber
+        mergedPct = round(mergedNumber / mergedTotal * 100, 2)
+        mergedCategories[lItem] = [mergedNumber, lName]
+        color = makeColor(mergedPct)
+        if sName != "" and lName != "" and mergedPct >= rfil or lDomain == sName:
+            tabs = lItem.count(';')
+            taxOutf.write(color + "    "*tabs + lName + ": " + str(mergedNumber) + " (" + str(mergedPct) + "% of rRNA)\n" + reset)
+    return mergedCategories
 
 """
-!!! NOT USED !!!.
+Not used by default; pick it with --merge union.
 This truly adds together SSU and LSU into one dictionary
 i.e. even if something in SSU isn't in LSU at all, it gets added.
 Now merged is everything in LSU and SSU, with matches having their totals added together.
@@ -197,128 +490,205 @@ This is a bad solution, because LSU and SSU are classified differently.
 Many of the 'middle' taxa levels are present in only SSU and not LSU. 
 So species from only SSU and only LSU get put in different places when they shouldn't be.
 """
-def True_rRNA_Merge(repFil):
-    global mergedCategories
+def True_rRNA_Merge(aggregator, taxOutf, repFil):
+    lsuCategories = aggregator.lsuCategories
+    ssuCategories = aggregator.ssuCategories
+    lsuTotal = aggregator.lsuTotal
+    ssuTotal = aggregator.ssuTotal
     mergedCategories = dict()
-    global mergedTotal
     mergedTotal = lsuTotal + ssuTotal
-    mergedPct = round(mergedTotal/total * 100, 2)
+    mergedPct = round(mergedTotal/aggregator.total * 100, 2)
     taxOutf.write("\nTotal rRNA: " + str(mergedTotal) + " (" + str(mergedPct) + "% of reads)\n\n")
     matchFil = 0.01
+    ssuIndex = mergeIndex(ssuCategories, aggregator.sortedSsu(), ssuTotal, matchFil)
 
-    for lItem in sortedLsu:
-        lDomain = lItem.split(";")[0]
+    for lItem in aggregator.sortedLsu():
+        lDomain = lItem.split(";", 1)[0]
         lName = lsuCategories[lItem][1]
         lNumber = lsuCategories[lItem][0]
         lPct = round(lNumber / lsuTotal * 100, 4)
-        match = False
 
         # First, see if lItem matches with anything in SSU. If it does, add counts together and append to merged dict.
-        for sItem in sortedSsu:
-            sDomain = sItem.split(";")[0]
-            sName = ssuCategories[sItem][1]
-            sNumber = ssuCategories[sItem][0]
-            sPct = round(sNumber / ssuTotal * 100, 4)
-            if sName == lName and sDomain == lDomain and lPct >= matchFil and sPct >= matchFil:
-                match = True
-                mergedNumber = sNumber + lNumber
-                mergedPct = round(mergedNumber / mergedTotal * 100, 2)
-                mergedCategories[lItem] = [mergedNumber, lName]
-                color = makeColor(mergedPct)
-                #if sName != "" and lName != "" and mergedPct >= repFil or sDomain == sName:
-                 #   tabs = lItem.count(';')
-                  #  taxOutf.write(color + "    "*tabs + lName + ": " + str(mergedNumber) + " (" + str(mergedPct) + "% of rRNA)\n" + reset)
-            
-            if match == True:    # if match already occurred, no need to search through the rest of the dict. Move on to the next LSU item.
-                break
-        if match == False:    # if after searching through all of SSU there was no match, 
-            if lPct > repFil:     # if the count is actually relatively high
-                newName = lName + ' (only LSU)'    #Add it to merged dict as well, but mention that it only comes from LSU.
-                mergedCategories[lItem] = [lNumber, newName]
-
-    # we need to do this again for SSU, to add the sizable elements from it that aren't in LSU. This involves matching again, so that we DON'T add matches (which were already added)
-    # That said, we don't need to search through all of lsuCategories, just the mergedCategories. It already has all the matches there and should be a good bit smaller.
-    for sItem in sortedSsu:
-        sDomain = sItem.split(";")[0]
+        sItem = None
+        if lPct >= matchFil:
+            sItem = ssuIndex.get((lDomain, lName))
+        if sItem is not None:
+            mergedCategories[lItem] = [ssuCategories[sItem][0] + lNumber, lName]
+        elif lPct > repFil:     # if no match but the count is actually relatively high
+            newName = lName + ' (only LSU)'    #Add it to merged dict as well, but mention that it only comes from LSU.
+            mergedCategories[lItem] = [lNumber, newName]
+
+    # we need to do this again for SSU, to add the sizable elements from it that aren't in LSU, so that we DON'T add matches (which were already added).
+    # Names tagged "(only LSU)" can never match an SSU name, so the keys of the matches are all we need to check against.
+    mergedKeys = set((mItem.split(";", 1)[0], mergedCategories[mItem][1]) for mItem in mergedCategories)
+    for sItem in aggregator.sortedSsu():
+        sDomain = sItem.split(";", 1)[0]
         sName = ssuCategories[sItem][1]
         sNumber = ssuCategories[sItem][0]
         sPct = round(sNumber / ssuTotal * 100, 4)
-        match = False
-        if sName == "Spermatophyta":
-            print(ssuCategories[sItem])
-            print(sPct)
-            break
-
-        # First, see if sItem is already in mergedCategories. If it is, move on.
-        for mItem in mergedCategories:
-            mDomain = mItem.split(";")[0]
-            mName = mergedCategories[mItem][1]
-            if sName == mName and sDomain == mDomain:
-                match = True
-                break
-        if match == False:    # if not already in mergedCategories
-            if sPct > repFil:     # if the count is actually relatively high
-                newName = sName + ' (only SSU)'    #Add it to merged dict as well, but mention that it only comes from LSU.
-                mergedCategories[sItem] = [sNumber, newName]
-
-    global sortedMerged
-    sortedMerged = sorted(mergedCategories)
-    for mItem in sortedMerged:
+        if (sDomain, sName) in mergedKeys:
+            continue
+        if sPct > repFil:     # if not already merged and the count is actually relatively high
+            newName = sName + ' (only SSU)'    #Add it to merged dict as well, but mention that it only comes from SSU.
+            mergedCategories[sItem] = [sNumber, newName]
+
+    for mItem in sorted(mergedCategories):
         mName = mergedCategories[mItem][1]
         mNumber = mergedCategories[mItem][0]
         mPct = round(mNumber / mergedTotal * 100, 4)
         color = makeColor(mPct)
         tabs = mItem.count(';')
         taxOutf.write(color + "    "*tabs + mName + ": " + str(mNumber) + " (" + str(mPct) + "% of rRNA)\n" + reset)
+    return mergedCategories
 
 
-def kronaGen(taxDict, sortDict, rRNA_type, typeTotal):
+"""
+Krona wants each category's OWN count (reads classified to it and no further), not the running total we keep.
+That's a category's count minus the counts of its direct children. A child's parent is just its full name
+without the last level, so every category subtracts itself from its parent in a single pass over the dict.
+"""
+def exclusiveCounts(taxDict):
     kronaDict = dict()
-    kronaOut = outbase + ".krona." + rRNA_type + ".txt"
-    kronaOutf = open(kronaOut, "w+")
-
-    for sortItem in sortDict:
-        name = taxDict[sortItem][1]
-        kronaNum = taxDict[sortItem][0]
-        sortTab = sortItem.count(';')
-        for numItem in taxDict:
-            numTab = numItem.count(';')
-            if sortItem in numItem and numTab == sortTab + 1:
-                kronaNum = kronaNum - taxDict[numItem][0]
-        kronaDict[sortItem] = kronaNum
+    for item in taxDict:
+        kronaDict[item] = taxDict[item][0]
+    for item in taxDict:
+        if ';' not in item:
+            continue
+        parent = item.rsplit(';', 1)[0]
+        if parent in kronaDict:
+            kronaDict[parent] -= taxDict[item][0]
+    return kronaDict
+
+"""Rows of the krona chart for one rRNA type, as (own count, [levels]) pairs. Tiny categories are left out."""
+def kronaRows(taxDict, sortDict, rRNA_type, typeTotal, total):
+    kronaDict = exclusiveCounts(taxDict)
     if rRNA_type == "lsu" or rRNA_type == "ssu":
-        kronaOutf.write(str(total - typeTotal) + "\t" + "non " + rRNA_type + " ribosomal RNA" + "\n")
+        rows = [(total - typeTotal, ["non " + rRNA_type + " ribosomal RNA"])]
     else:
-        kronaOutf.write(str(total - typeTotal) + "\t" + "non-ribosomal RNA" + "\n")
+        rows = [(total - typeTotal, ["non-ribosomal RNA"])]
     for item in sortDict:
         count = kronaDict[item]
         if round(count / typeTotal * 100 , 2) > 0.05:
-            kronaOutf.write(str(kronaDict[item]) + "\tribosomal RNA\t" + item.replace(";", "\t") + "\n")
+            rows.append((count, ["ribosomal RNA"] + item.split(";")))
+    return rows
+
+"""Writes the krona text file for one rRNA type (the format ktImportText reads) and returns its rows"""
+def kronaGen(taxDict, sortDict, rRNA_type, typeTotal, total, outbase):
+    rows = kronaRows(taxDict, sortDict, rRNA_type, typeTotal, total)
+    kronaOutf = open(outbase + ".krona." + rRNA_type + ".txt", "w+")
+    for count, path in rows:
+        kronaOutf.write(str(count) + "\t" + "\t".join(path) + "\n")
     kronaOutf.close()
+    return rows
 
 """Function manually called to do all the reporting work"""
-def main_taxa(filter):
+def main_taxa(infile, outbase, filter, merge="matched", threads=1, statePath=None, interval=0, resume=False, cache=None,
+              refCacheSize=defaultSize, preload=False, engine="twophase"):
     print("Parsing data...")
-    TaxParser()
+    taxOutf = open(outbase + ".taxstats.txt", "w+")
+    aggregator = TaxParser(infile, taxOutf, filter, threads, statePath, interval, resume, cache, refCacheSize, preload, engine)
     print("Merging lsu and ssu...")
-    rRNA_Merge(filter)
+    if merge == "union":
+        mergedCategories = True_rRNA_Merge(aggregator, taxOutf, filter)
+    else:
+        mergedCategories = rRNA_Merge(aggregator, taxOutf, filter)
+    taxOutf.close()
+    return aggregator, mergedCategories
 
-def main_krona():
+def main_krona(aggregator, mergedCategories, outbase, bundle=False, kronaUrl=None):
     print("Generating interactive krona charts...")
-    kronaGen(mergedCategories, sortedMerged, "merged", mergedTotal)
-    os.system("ktImportText %s -o %s.krona.%s.html"
-              % (infile, outbase, rrnatype))
-    kronaGen(ssuCategories, sortedSsu, "ssu", ssuTotal)
-    os.system("ktImportText %s -o %s.krona.%s.html"
-              % (infile, outbase, rrnatype))
-    kronaGen(lsuCategories, sortedLsu, "lsu", lsuTotal)
-    os.system("ktImportText %s -o %s.krona.%s.html"
-              % (infile, outbase, rrnatype))
+    mergedTotal = aggregator.lsuTotal + aggregator.ssuTotal
+    ssuCategories = aggregator.ssuCategories
+    lsuCategories = aggregator.lsuCategories
+    datasets = [
+        ("merged", kronaGen(mergedCategories, sorted(mergedCategories), "merged", mergedTotal, aggregator.total, outbase)),
+        ("ssu", kronaGen(ssuCategories, aggregator.sortedSsu(), "ssu", aggregator.ssuTotal, aggregator.total, outbase)),
+        ("lsu", kronaGen(lsuCategories, aggregator.sortedLsu(), "lsu", aggregator.lsuTotal, aggregator.total, outbase))]
+    if bundle:
+        writeKrona(outbase + ".krona.html", datasets, url=kronaUrl)
+    else:
+        for rrnatype, rows in datasets:
+            writeKrona("%s.krona.%s.html" % (outbase, rrnatype), [(rrnatype, rows)], url=kronaUrl)
     print("All krona files created!")
 
+"""Every category count of a sample, as the {rna: {lineage: count}} tables and totals that taxcounts.writeCounts stores"""
+def countTables(aggregator, mergedCategories):
+    tables = dict()
+    tables["LSU"] = dict((path, node.count) for path, node in aggregator.lsuTrie.walk())
+    tables["SSU"] = dict((path, node.count) for path, node in aggregator.ssuTrie.walk())
+    tables["merged"] = dict((fullName, mergedCategories[fullName][0]) for fullName in mergedCategories)
+    totals = {"reads": aggregator.total, "LSU": aggregator.lsuTotal, "SSU": aggregator.ssuTotal,
+              "merged": aggregator.lsuTotal + aggregator.ssuTotal}
+    return tables, totals
+
+def main_counts(aggregator, mergedCategories, outbase):
+    from taxcounts import writeCounts    # NumPy is only needed for this output
+    tables, totals = countTables(aggregator, mergedCategories)
+    writeCounts(outbase + ".counts", tables, totals)
+
+"""Reads a batch manifest into a list of (sample name, .sam path), skipping blank and '#' lines"""
+def readManifest(manifest):
+    samples = []
+    with open(manifest, "r") as inf:
+        for line in inf:
+            if line.strip() == "" or line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 2:
+                print("manifest lines must be <sample name><tab><path to .sam>: " + line.rstrip("\n"))
+                sys.exit(1)
+            samples.append((fields[0], fields[1]))
+    return samples
+
+"""
+Does all the reporting work for one sample of a batch (a job of samplematrix.runBatch),
+and hands back its count tables for the combined matrix.
+"""
+def processSample(job):
+    sample, infile, outbase, filter, merge, krona, bundle, counts, cache, refCacheSize, preload, engine, kronaUrl = job
+    sampleBase = outbase + "." + sample
+    taxOutf = open(sampleBase + ".taxstats.txt", "w+")
+    aggregator = TaxParser(infile, taxOutf, filter, cache=cache, refCacheSize=refCacheSize, preload=preload, engine=engine)
+    if merge == "union":
+        mergedCategories = True_rRNA_Merge(aggregator, taxOutf, filter)
+    else:
+        mergedCategories = rRNA_Merge(aggregator, taxOutf, filter)
+    taxOutf.close()
+    if krona:
+        main_krona(aggregator, mergedCategories, sampleBase, bundle, kronaUrl)
+    if counts:
+        main_counts(aggregator, mergedCategories, sampleBase)
+    tables, totals = countTables(aggregator, mergedCategories)
+    return sample, tables, totals
+
+"""Batch mode: every sample of the manifest on a shared pool of worker processes"""
+def main_batch(manifest, outbase, filter, merge="matched", krona=True, bundle=False, counts=False, threads=1, cache=None,
+               refCacheSize=defaultSize, preload=False, engine="twophase", kronaUrl=None):
+    jobs = [(sample, infile, outbase, filter, merge, krona, bundle, counts, cache, refCacheSize, preload, engine, kronaUrl)
+            for sample, infile in readManifest(manifest)]
+    samples, sampleTables, sampleTotals = runBatch(processSample, jobs, threads)
+    writeMatrix(outbase + ".taxmatrix.txt", samples, sampleTables, sampleTotals)
+
 if __name__ == "__main__":
-    main_taxa(filter)
-    if krona == True:
-        main_krona()
+    args = parser_gen()
+    krona = args.krona.lower() == "true" or args.krona.lower() == "t"
+    bundle = args.kronabundle.lower() == "true" or args.kronabundle.lower() == "t"
+    counts = args.counts.lower() == "true" or args.counts.lower() == "t"
+    preload = args.preload.lower() == "true" or args.preload.lower() == "t"
+    cache = None
+    if args.cache:
+        cache = TaxCache(args.cache, int(args.cachesize * 1024 * 1024))
+    if args.manifest:
+        main_batch(args.manifest, args.outbase, args.filter, args.merge, krona, bundle, counts, args.threads, cache,
+                   args.refcache, preload, args.engine, args.kronaurl)
+    else:
+        resume = args.resume.lower() == "true" or args.resume.lower() == "t"
+        statePath = args.state or args.outbase + ".state"
+        aggregator, mergedCategories = main_taxa(args.infile, args.outbase, args.filter, args.merge, args.threads,
+                                                 statePath, args.checkpoint, resume, cache, args.refcache, preload, args.engine)
+        if krona:
+            main_krona(aggregator, mergedCategories, args.outbase, bundle, args.kronaurl)
+        if counts:
+            main_counts(aggregator, mergedCategories, args.outbase)
     print("bbmap analysis complete!")
     exit(0)
@@ -0,0 +1,162 @@
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.dirname(here)
+sys.path.insert(0, repo)
+
+"""
+Throughput benchmarks for the scripts in this repo, on synthetic inputs written by synthdata.py.
+
+Every benchmark runs in its own process, so the peak RSS reported is that benchmark's alone.
+Whole scripts are timed from the command line; the bbmaptax stages (TaxParser, rRNA_Merge, kronaGen)
+are timed inside a child process running this file with --stage, which only times the stage itself.
+
+    python benchmarks/benchmark.py --reads 1000000 --save before.json
+    (change things)
+    python benchmarks/benchmark.py --reads 1000000 --compare before.json
+
+--compare exits with status 1 if any benchmark got slower by more than --tolerance.
+"""
+
+
+"""Runs one command, returning (wall seconds, peak RSS in MB, stdout)"""
+def measure(command, cwd):
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out = proc.stdout.read()
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        print("command failed: " + " ".join(command))
+        sys.exit(1)
+    return elapsed, rusage.ru_maxrss / 1024, out.decode()
+
+
+"""
+Stages timed inside a child process. Each prints {"items": ..., "seconds": ...} as JSON,
+counting only the work of the stage (not the setup before it).
+"""
+def runStage(stage, sam):
+    import bbmaptax
+    if stage == "TaxParser":
+        start = time.perf_counter()
+        aggregator = bbmaptax.TaxParser(sam, io.StringIO(), 0.2)
+        elapsed = time.perf_counter() - start
+        items = aggregator.total
+    else:
+        with open(sam, "r") as inf:
+            aggregator = bbmaptax.TaxonomyAggregator().consume(inf)
+        items = len(aggregator.lsuCategories) + len(aggregator.ssuCategories)
+        if stage == "rRNA_Merge":
+            start = time.perf_counter()
+            bbmaptax.rRNA_Merge(aggregator, io.StringIO(), 0.2)
+            elapsed = time.perf_counter() - start
+        elif stage == "kronaGen":
+            mergedCategories = bbmaptax.rRNA_Merge(aggregator, io.StringIO(), 0.2)
+            outbase = os.path.join(os.path.dirname(sam), "stage")
+            start = time.perf_counter()
+            bbmaptax.kronaGen(aggregator.lsuCategories, aggregator.sortedLsu(), "lsu", aggregator.lsuTotal, aggregator.total, outbase)
+            bbmaptax.kronaGen(aggregator.ssuCategories, aggregator.sortedSsu(), "ssu", aggregator.ssuTotal, aggregator.total, outbase)
+            bbmaptax.kronaGen(mergedCategories, sorted(mergedCategories), "merged",
+                              aggregator.lsuTotal + aggregator.ssuTotal, aggregator.total, outbase)
+            elapsed = time.perf_counter() - start
+    print(json.dumps({"items": items, "seconds": elapsed}))
+
+
+"""(name, command, unit) of every benchmark. Commands run from the directory holding the inputs."""
+def benchmarks(workdir, reads):
+    python = sys.executable
+    script = lambda name: os.path.join(repo, name)
+    stage = lambda name: [python, os.path.abspath(__file__), "--stage", name, "--sam", os.path.join(workdir, "bench.sam")]
+    return [
+        ("bbmaptax.TaxParser", stage("TaxParser"), "reads"),
+        ("bbmaptax.rRNA_Merge", stage("rRNA_Merge"), "categories"),
+        ("bbmaptax.kronaGen", stage("kronaGen"), "categories"),
+        ("bbmaptax.py", [python, script("bbmaptax.py"), "-i", "bench.sam", "-o", "bench", "--krona", "t"], "reads"),
+        ("bbmaptax.py legacy", [python, script("bbmaptax.py"), "-i", "bench.sam", "-o", "benchlegacy", "--krona", "t", "--engine", "legacy"], "reads"),
+        ("bbmaptax.py bgzf", [python, script("bbmaptax.py"), "-i", "bench.sam.bgz", "-o", "benchbgzf", "--krona", "t"], "reads"),
+        ("bbmapparse.py", [python, script("bbmapparse.py"), "-i", "bench.sam", "--test", "Taxon_1_1", "--reportnum", "0"], "reads"),
+        ("metaxa2merge.py", [python, script("metaxa2merge.py"), "--lsu", "lsu.taxonomy.txt", "--ssu", "ssu.taxonomy.txt", "-o", "taxmerge.txt"], "reads"),
+        ("metaxa2merge.py legacy", [python, script("metaxa2merge.py"), "--lsu", "lsu.taxonomy.txt", "--ssu", "ssu.taxonomy.txt", "-o", "taxmerge.legacy.txt", "--engine", "legacy"], "reads"),
+        ("metaxa2stats.py", [python, script("metaxa2stats.py"), "-i", "lsu.taxonomy.txt", "-o", "taxstats.txt", "--taxlevel", "3"], "reads"),
+        ("metaxa2stats.py numpy", [python, script("metaxa2stats.py"), "-i", "lsu.taxonomy.txt", "-o", "taxstats.numpy.txt", "--taxlevel", "3", "--engine", "numpy"], "reads"),
+        ("metaxaunique.py", [python, script("metaxaunique.py"), "--input1", "lsu.taxonomy.txt", "--input2", "ssu.taxonomy.txt"], "reads"),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the scripts of this repo on synthetic data, reporting throughput and peak memory.")
+    parser.add_argument("--reads", type=int, default=200000, help="reads per synthetic input. Default 200000")
+    parser.add_argument("--depth", type=int, default=8, help="maximum lineage depth. Default 8")
+    parser.add_argument("--refs", type=int, default=50000, help="references (@SQ lines) in the synthetic .sam. Default 50000")
+    parser.add_argument("--only", nargs="+", help="only run benchmarks whose name starts with one of these")
+    parser.add_argument("--workdir", help="keep the inputs and outputs in this directory instead of a temporary one")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier --save to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against --compare, as a fraction. Default 0.2")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    parser.add_argument("--sam", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        runStage(args.stage, args.sam)
+        sys.exit(0)
+
+    tmp = None
+    workdir = args.workdir
+    if not workdir:
+        tmp = tempfile.TemporaryDirectory()
+        workdir = tmp.name
+    os.makedirs(workdir, exist_ok=True)
+    print("Generating %d-read inputs in %s..." % (args.reads, workdir))
+    # Generated in child processes: on Linux a child's peak RSS starts out at its parent's,
+    # so this process has to stay small for the numbers below to mean anything.
+    generate = [sys.executable, os.path.join(here, "synthdata.py")]
+    size = ["--reads", str(args.reads), "--depth", str(args.depth)]
+    measure(generate + ["sam", "-o", "bench.sam", "--refs", str(args.refs)] + size, workdir)
+    measure(generate + ["sam", "-o", "bench.sam.bgz", "--bgzf", "--refs", str(args.refs)] + size, workdir)
+    measure(generate + ["metaxa", "-o", "lsu.taxonomy.txt", "--seed", "1"] + size, workdir)
+    measure(generate + ["metaxa", "-o", "ssu.taxonomy.txt", "--seed", "2"] + size, workdir)
+
+    results = dict()
+    print("\n%-22s %12s %10s %22s %12s" % ("benchmark", "items", "seconds", "items/sec", "peak RSS MB"))
+    for name, command, unit in benchmarks(workdir, args.reads):
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        elapsed, rss, out = measure(command, workdir)
+        items = args.reads
+        if "--stage" in command:
+            stageResult = json.loads(out.strip().splitlines()[-1])
+            items, elapsed = stageResult["items"], stageResult["seconds"]
+        rate = items / elapsed if elapsed > 0 else float("inf")
+        results[name] = {"items": items, "unit": unit, "seconds": elapsed, "rate": rate, "peakRssMB": rss}
+        print("%-22s %12d %10.3f %22s %12.1f" % (name, items, elapsed, "%.0f %s/s" % (rate, unit), rss))
+
+    if args.save:
+        with open(args.save, "w") as outf:
+            json.dump(results, outf, indent=2)
+    status = 0
+    if args.compare:
+        with open(args.compare, "r") as inf:
+            baseline = json.load(inf)
+        print("")
+        for name in results:
+            if name not in baseline:
+                continue
+            change = results[name]["rate"] / baseline[name]["rate"] - 1
+            flag = ""
+            if change < -args.tolerance:
+                flag = "  <-- REGRESSION"
+                status = 1
+            print("%-22s %+7.1f%% throughput%s" % (name, change * 100, flag))
+    if tmp:
+        tmp.cleanup()
+    sys.exit(status)
@@ -0,0 +1,120 @@
+import argparse
+import os
+import random
+import struct
+import zlib
+
+"""
+Synthetic inputs for the benchmarks: bbmap .sam files mapped against a SILVA-like reference,
+and Metaxa2 metaxa.taxonomy.txt files, at any number of reads and lineage depth.
+
+The .sam starts with one @SQ line per reference, like a real bbmap run against SILVA (hundreds of
+thousands of lines at full size). Reference names look like "tid|<id>|LSU <lineage>", and reads
+hit references with a skewed (Zipf-like) frequency, so a few taxa dominate as in real libraries.
+Metaxa2 files share their read IDs, so LSU and SSU files of the same "library" overlap the way real runs do.
+"""
+
+domains = ["Eukaryota", "Bacteria", "Archaea"]
+
+
+"""A random taxonomy: nLineages lineages of up to depth levels each, sharing their upper levels"""
+def makeLineages(nLineages, depth, rng):
+    lineages = []
+    for i in range(nLineages):
+        lineage = [rng.choice(domains)]
+        for level in range(1, rng.randint(max(1, depth // 2), depth)):
+            # few names near the root, more further down, so upper levels are shared a lot
+            lineage.append("Taxon_%d_%d" % (level, rng.randint(0, 2 ** min(level + 1, 12))))
+        if rng.random() < 0.1:
+            lineage[-1] = lineage[-1] + " sp. clone " + str(i)    # names with spaces and digits
+        lineages.append(lineage)
+    return lineages
+
+"""Reference index picked with a skewed frequency: the first references get most of the reads"""
+def skewedIndex(n, rng):
+    return min(int(rng.paretovariate(1.2)) - 1, n - 1)
+
+def readId(i):
+    return "MISEQ06:640:000000000-AWW91:%d:%d:%d:%d" % (1 + i % 4, 1101 + (i // 4) % 1000, 1000 + (i // 4000) % 30000, 1000 + i % 60000)
+
+def writeSam(path, reads, depth=8, nRefs=50000, unmapped=0.4, seed=1):
+    rng = random.Random(seed)
+    lineages = makeLineages(nRefs, depth, rng)
+    refs = []
+    for i, lineage in enumerate(lineages):
+        rna = "LSU" if i % 2 else "SSU"
+        refs.append("tid|%d|%s %s" % (100000 + i, rna, ";".join(lineage)))
+    outf = open(path, "w")
+    outf.write("@HD\tVN:1.4\tSO:unsorted\n")
+    for ref in refs:
+        outf.write("@SQ\tSN:%s\tLN:%d\n" % (ref, rng.randint(1200, 3000)))
+    outf.write("@PG\tID:BBMap\tPN:BBMap\tVN:38.22\n")
+    order = list(range(nRefs))
+    rng.shuffle(order)
+    for i in range(reads):
+        if rng.random() < unmapped:
+            ref, flag, pos, cigar = "*", 4, 0, "*"
+        else:
+            ref, flag, pos, cigar = refs[order[skewedIndex(nRefs, rng)]], 0, rng.randint(1, 1200), "150M"
+        outf.write("%s\t%d\t%s\t%d\t%d\t%s\t*\t0\t0\t%s\t%s\n" % (readId(i), flag, ref, pos, 40 if pos else 0, cigar, "ACGT" * 37 + "AC", "F" * 150))
+    outf.close()
+
+"""Metaxa2 lineage column: up to 8 levels, with the trailing ';' Metaxa2 puts after a species"""
+def metaxaLineage(lineage, depth):
+    levels = lineage[:depth]
+    text = ";".join(levels)
+    if len(levels) >= 8:
+        text += ";"
+    return text
+
+def writeMetaxa(path, reads, depth=8, nLineages=2000, overlap=0.5, seed=1):
+    rng = random.Random(seed)
+    lineages = makeLineages(nLineages, max(depth, 2), random.Random(0))
+    lineages += [["Mitochondria"], ["Chloroplast", "Unknown Eukaryote"], ["Eukaryota"]]
+    outf = open(path, "w")
+    for i in range(reads):
+        # with overlap=0.5, half of the read IDs are shared with any other file made with a different seed
+        n = i if rng.random() < overlap else reads * (seed + 1) + i
+        lineage = lineages[skewedIndex(len(lineages), rng)]
+        identity = rng.choice(["100", "99.3", "97.5", "N/A"])
+        outf.write("%s\t%s\t%s\t%s\t%s\n" % (readId(n), metaxaLineage(lineage, depth), identity, rng.choice(["150", "148", "N/A"]), rng.choice(["100", "80", "N/A"])))
+    outf.close()
+
+"""
+Compresses a file to BGZF, the way bgzip does: independent deflate blocks of up to 64 KB,
+each with the 'BC' extra field holding its size, then an empty end-of-file block.
+"""
+def writeBgzf(src, dst, level=6):
+    inf = open(src, "rb")
+    outf = open(dst, "wb")
+    while True:
+        data = inf.read(65280)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        outf.write(struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25))
+        outf.write(cdata)
+        outf.write(struct.pack("<II", zlib.crc32(data), len(data)))
+        if not data:
+            break
+    inf.close()
+    outf.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes synthetic bbmap .sam or Metaxa2 .taxonomy.txt files for benchmarking.")
+    parser.add_argument("kind", choices=["sam", "metaxa"])
+    parser.add_argument("-o", "--output", required=True, help="output file")
+    parser.add_argument("--reads", type=int, default=100000, help="number of reads. Default 100000")
+    parser.add_argument("--depth", type=int, default=8, help="maximum lineage depth. Default 8")
+    parser.add_argument("--refs", type=int, default=50000, help="number of references in the .sam header. Default 50000")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bgzf", action="store_true", help="write the output BGZF compressed (like bgzip)")
+    args = parser.parse_args()
+    output = args.output + ".plain" if args.bgzf else args.output
+    if args.kind == "sam":
+        writeSam(output, args.reads, args.depth, args.refs, seed=args.seed)
+    else:
+        writeMetaxa(output, args.reads, args.depth, seed=args.seed)
+    if args.bgzf:
+        writeBgzf(output, args.output)
+        os.remove(output)
@@ -0,0 +1,201 @@
+import collections
+import gzip
+import io
+import os
+import stat
+import struct
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Transparent reading of compressed inputs, so .sam and metaxa.taxonomy.txt files don't have to be
+decompressed to disk first. The format is picked from the first bytes of the file, not its name:
+
+    plain text   read as is
+    gzip (.gz)   read with the gzip module
+    BGZF (.bgz, bgzip output, the container BAM files use)
+                 split into its independent blocks (at most 64 KB each), which are inflated by
+                 zlib in a pool of threads (zlib releases the GIL) and handed back in order
+    BAM          BGZF holding binary alignments; these come out as SAM lines with the first five
+                 columns (read ID, flag, reference name, position, mapping quality), which is all
+                 of the record any script here looks at
+
+Everything downstream just reads lines, so openBinary/openText can stand in for open(path, "rb"/"r").
+The format is told from the stream that is then read, so inputs that can only be read once
+(stdin, named pipes, <(samtools view ...) process substitution) work the same as files.
+"""
+
+gzipMagic = b"\x1f\x8b"
+bamMagic = b"BAM\x01"
+
+
+def defaultThreads():
+    return min(4, os.cpu_count() or 1)
+
+"""True for stdin and anything else that isn't a regular file (a named pipe, /dev/fd/N...): it can only be read once, and not seeked"""
+def isStream(path):
+    return path == "-" or not stat.S_ISREG(os.stat(path).st_mode)
+
+"""True if the regular file starts like gzip (which includes BGZF and BAM). Use openDetected for streams."""
+def isCompressed(path):
+    with open(path, "rb") as f:
+        return f.read(2) == gzipMagic
+
+"""True if a gzip header (at least the first 18 bytes of the file) carries the BGZF 'BC' extra field"""
+def isBgzf(header):
+    if len(header) < 18 or header[:2] != gzipMagic or not header[3] & 4:
+        return False
+    return bgzfBlockSize(header[12:12 + struct.unpack_from("<H", header, 10)[0]]) is not None
+
+"""BSIZE (total block size - 1) out of the extra field of a BGZF block header, or None if it isn't there"""
+def bgzfBlockSize(extra):
+    pos = 0
+    while pos + 4 <= len(extra):
+        length = struct.unpack_from("<H", extra, pos + 2)[0]
+        if extra[pos:pos + 2] == b"BC" and length == 2:
+            return struct.unpack_from("<H", extra, pos + 4)[0]
+        pos += 4 + length
+    return None
+
+
+"""Inflates one BGZF block. Runs in a pool thread."""
+def inflateBlock(block):
+    data, size = block
+    out = zlib.decompress(data, wbits=-15)
+    if len(out) != size:
+        raise ValueError("corrupt BGZF block: inflated to %d bytes, expected %d" % (len(out), size))
+    return out
+
+"""
+Inflated contents of the BGZF blocks of a binary stream, in order. Up to threads * 4 blocks are
+read ahead and inflated at once, so decompression runs on several cores while the caller parses.
+"""
+def bgzfBlocks(f, threads):
+    with ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        while True:
+            header = f.read(12)
+            if not header:
+                break
+            if len(header) < 12 or header[:2] != gzipMagic or not header[3] & 4:
+                raise ValueError("not a BGZF block (a plain gzip member concatenated to a BGZF file?)")
+            xlen = struct.unpack_from("<H", header, 10)[0]
+            extra = f.read(xlen)
+            bsize = bgzfBlockSize(extra)
+            if bsize is None:
+                raise ValueError("BGZF block without a BC field")
+            rest = f.read(bsize - xlen - 11)    # compressed data, CRC32 and ISIZE
+            if len(rest) != bsize - xlen - 11:
+                raise ValueError("truncated BGZF block")
+            pending.append(pool.submit(inflateBlock, (rest[:-8], struct.unpack_from("<I", rest, len(rest) - 4)[0])))
+            if len(pending) >= threads * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+"""Read-only raw stream over an iterator of bytes chunks, so it can be wrapped in io.BufferedReader"""
+class ChunkStream(io.RawIOBase):
+    def __init__(self, chunks, source=None):
+        self.chunks = iter(chunks)
+        self.source = source
+        self.chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.chunk):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+        n = min(len(buffer), len(self.chunk))
+        buffer[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+        super().close()
+
+
+"""Reads exactly n bytes, or raises ValueError if the stream ends first"""
+def readExactly(stream, n):
+    data = stream.read(n)
+    if len(data) != n:
+        raise ValueError("truncated BAM file")
+    return data
+
+"""
+SAM lines (as bytes, in batches) out of the inflated contents of a BAM file: the header text,
+then per alignment: read ID, flag, reference name ('*' if unmapped), 1-based position and mapping quality.
+"""
+def bamLines(stream):
+    if stream.read(4) != bamMagic:
+        raise ValueError("not a BAM file")
+    text = readExactly(stream, struct.unpack("<i", readExactly(stream, 4))[0]).rstrip(b"\0")
+    if text and not text.endswith(b"\n"):
+        text += b"\n"
+    yield text
+    names = []
+    for i in range(struct.unpack("<i", readExactly(stream, 4))[0]):
+        nameLength = struct.unpack("<i", readExactly(stream, 4))[0]
+        names.append(readExactly(stream, nameLength)[:-1])
+        readExactly(stream, 4)    # reference length
+    batch = []
+    while True:
+        blockSize = stream.read(4)
+        if not blockSize:
+            break
+        if len(blockSize) < 4:
+            raise ValueError("truncated BAM file")
+        record = readExactly(stream, struct.unpack("<i", blockSize)[0])
+        refId, pos, nameLength, mapq, bin, nCigar, flag = struct.unpack_from("<iiBBHHH", record)
+        refName = names[refId] if refId >= 0 else b"*"
+        batch.append(b"%s\t%d\t%s\t%d\t%d\n" % (record[32:31 + nameLength], flag, refName, pos + 1, mapq))
+        if len(batch) >= 4096:
+            yield b"".join(batch)
+            batch = []
+    if batch:
+        yield b"".join(batch)
+
+
+"""
+Opens a plain, gzip, BGZF or BAM file ('-' for stdin) as a binary stream of its (text) contents.
+threads is the number of threads inflating BGZF blocks; by default up to 4.
+Returns (stream, compressed). The file is opened once, and the format told from its first bytes with peek,
+so nothing is lost from a pipe. An uncompressed file comes back as the plain file object, which can seek if the file can.
+"""
+def openDetected(path, threads=None):
+    f = sys.stdin.buffer if path == "-" else open(path, "rb")
+    header = f.peek(18)[:18]
+    if header[:2] != gzipMagic:
+        return f, False
+    if isBgzf(header):
+        stream = io.BufferedReader(ChunkStream(bgzfBlocks(f, threads or defaultThreads()), f), 1 << 20)
+    elif isStream(path):
+        stream = gzip.GzipFile(fileobj=f)
+    else:
+        f.close()
+        stream = gzip.open(path, "rb")
+    if stream.peek(4)[:4] == bamMagic:
+        stream = io.BufferedReader(ChunkStream(bamLines(stream), stream), 1 << 20)
+    return stream, True
+
+def openBinary(path, threads=None):
+    return openDetected(path, threads)[0]
+
+"""openBinary, decoded: a drop-in for open(path, "r")"""
+def openText(path, threads=None):
+    return io.TextIOWrapper(openBinary(path, threads))
+
+"""Reads and throws away the first n bytes of a stream that can't seek (e.g. to resume part way through a compressed file)"""
+def skipBytes(stream, n):
+    while n > 0:
+        data = stream.read(min(n, 1 << 20))
+        if not data:
+            break
+        n -= len(data)
@@ -0,0 +1,79 @@
+import os
+from xml.sax.saxutils import escape, quoteattr
+
+"""
+Writes Krona charts straight from Python, without going through text files and ktImportText.
+
+Rows are the same thing ktImportText reads from a Krona text file: (count, [level1, level2, ...]),
+where count is the number of reads assigned to exactly that path. Several datasets can go in
+one file; Krona then shows a dataset picker next to the chart.
+The page pulls the Krona javascript and images from url, same as ktImportText -u does, so unlike a plain
+ktImportText chart it isn't self-contained: by default url is the Krona website, and the chart needs internet
+access to render. Point url (or the KRONA_URL environment variable) at a local Krona install, the directory
+holding its src/ and img/, to view charts offline.
+"""
+
+kronaUrl = os.environ.get("KRONA_URL", "http://marbl.github.io/Krona")
+
+header = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <meta charset="utf-8"/>
+  <link rel="shortcut icon" href="%(url)s/img/favicon.ico"/>
+  <script id="notfound">window.onload=function(){document.body.innerHTML="Could not get resources from \\"%(url)s\\"."}</script>
+  <script src="%(url)s/src/krona-2.0.js"></script>
+ </head>
+ <body>
+  <img id="hiddenImage" src="%(url)s/img/hidden.png" style="display:none"/>
+  <img id="loadingImage" src="%(url)s/img/loading.gif" style="display:none"/>
+  <noscript>Javascript must be enabled to view this page.</noscript>
+  <div style="display:none">
+  <krona collapse="true" key="true">
+   <attributes magnitude="magnitude">
+    <attribute display="Total">magnitude</attribute>
+   </attributes>
+"""
+
+footer = """  </krona>
+</div></body></html>
+"""
+
+
+"""
+Builds the chart tree from the rows of every dataset.
+Each node is [magnitudes, children], with one magnitude per dataset. Krona magnitudes include everything
+below the node, so each row's count goes to every node on its path (and to the root).
+"""
+def buildTree(datasets):
+    nSets = len(datasets)
+    root = [[0] * nSets, dict()]
+    for i, (name, rows) in enumerate(datasets):
+        for count, path in rows:
+            node = root
+            node[0][i] += count
+            for level in path:
+                if level not in node[1]:
+                    node[1][level] = [[0] * nSets, dict()]
+                node = node[1][level]
+                node[0][i] += count
+    return root
+
+def writeNode(outf, name, node, depth):
+    indent = " " * depth
+    outf.write(indent + "<node name=" + quoteattr(name) + ">\n")
+    outf.write(indent + " <magnitude>" + "".join("<val>" + str(val) + "</val>" for val in node[0]) + "</magnitude>\n")
+    for childName, child in node[1].items():
+        writeNode(outf, childName, child, depth + 1)
+    outf.write(indent + "</node>\n")
+
+"""Writes one Krona html file holding every (dataset name, rows) pair in datasets"""
+def writeKrona(path, datasets, rootName="all", url=None):
+    outf = open(path, "w")
+    outf.write(header % {"url": (url or kronaUrl).rstrip("/")})
+    outf.write("   <datasets>\n")
+    for name, rows in datasets:
+        outf.write("    <dataset>" + escape(name) + "</dataset>\n")
+    outf.write("   </datasets>\n")
+    writeNode(outf, rootName, buildTree(datasets), 0)
+    outf.write(footer)
+    outf.close()
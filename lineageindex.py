@@ -0,0 +1,94 @@
+from multimatch import PatternAutomaton
+from metaxa2io import splitLineage
+
+"""
+Per-reference lookup of which bbmapparse.py queries a read matches.
+
+A SILVA-mapped .sam has far fewer distinct references than reads, so each reference name is parsed
+(rRNA type, lineage split into its levels) and checked against every query only the first time it's seen.
+Every later read mapped to it is one dict lookup on the raw reference name, however long the lineage
+or however many queries there are.
+
+Query terms:
+    Fungi      Fungi anywhere in the lineage text, as a substring, which is how --test always worked
+               (so it also matches inside longer names, e.g. "Fungi_X" or "unidentified Fungi")
+    =Fungi     a level named exactly Fungi, at any rank
+    3=Fungi    the level at rank 3 (the domain is rank 0) is named exactly Fungi
+A query matches a lineage when all its test terms and none of its untest terms do.
+All substring terms of all queries are looked for in one pass with an Aho-Corasick automaton (multimatch.py).
+"""
+
+
+"""(kind, rank, name) of one term: kind is "substring", "exact" (any rank) or "rank"."""
+def parseTerm(term):
+    rank, sep, name = term.partition("=")
+    if sep and rank == "":
+        return ("exact", None, name)
+    if sep and rank.isdigit():
+        return ("rank", int(rank), name)
+    return ("substring", None, term)
+
+
+class LineageIndex:
+    """queries is a list of (test terms, untest terms)"""
+    def __init__(self, queries):
+        patterns = []
+        patternIndex = dict()
+        self.queries = []
+        for tests, untests in queries:
+            compiled = []
+            for terms in (tests, untests):
+                parsed = []
+                for term in terms:
+                    kind, rank, name = parseTerm(term)
+                    if kind == "substring":
+                        if name not in patternIndex:
+                            patternIndex[name] = len(patterns)
+                            patterns.append(name)
+                        name = patternIndex[name]
+                    parsed.append((kind, rank, name))
+                compiled.append(parsed)
+            self.queries.append(tuple(compiled))
+        self.automaton = PatternAutomaton(patterns)
+        self.references = dict()    # raw reference name -> (rna type, lineage text, lineage levels, indexes of the queries it matches)
+        self.lineages = dict()      # so references with the same lineage share one tuple of levels
+
+    def termHolds(self, term, found, levels):
+        kind, rank, name = term
+        if kind == "substring":
+            return name in found
+        if kind == "exact":
+            return name in levels
+        return rank < len(levels) and levels[rank] == name
+
+    """
+    (rna type, lineage text, lineage levels, matching query indexes) for a reference name as bytes, straight out of the .sam.
+    Names without a lineage (no ';', e.g. '*' for unmapped reads) give (None, None, None, ()).
+    rna type is "LSU", "SSU" or None if the name says neither.
+    """
+    def lookup(self, region):
+        reference = self.references.get(region)
+        if reference is None:
+            reference = self.build(region)
+            self.references[region] = reference
+        return reference
+
+    def build(self, region):
+        if b";" not in region:
+            return (None, None, None, ())
+        text = region.decode()
+        if "LSU" in text:
+            rna = "LSU"
+        elif "SSU" in text:
+            rna = "SSU"
+        else:
+            rna = None
+        taxa = " ".join(text.split()[1:])
+        levels = tuple(splitLineage(taxa))    # empty levels keep their place, so ranks line up; only a trailing ";" is dropped
+        levels = self.lineages.setdefault(levels, levels)
+        found = self.automaton.search(taxa)
+        matches = []
+        for i, (tests, untests) in enumerate(self.queries):
+            if all(self.termHolds(term, found, levels) for term in tests) and not any(self.termHolds(term, found, levels) for term in untests):
+                matches.append(i)
+        return (rna, taxa, levels, tuple(matches))
@@ -1,9 +1,11 @@
 import argparse
 import sys
-import re
 
 from sty import fg, bg, ef, rs
 
+from metaxa2io import parseLineage
+from compressedio import openText
+
 parser = argparse.ArgumentParser(description='Takes both lsu and ssu metaxa runs of the same dataset and merges results. If just one of the two provided it will still report its stats.')
 required = parser.add_argument_group('required arguments')
 optional = parser.add_argument_group('optional arguments')
@@ -12,8 +14,8 @@ optional.add_argument("--filter", type=float, default=1, help="If a particular t
 \	less than this percent of the total reads, iit doesn't report that classification in the results.\
 \	Exception for the Domain level, which will always be reported. \
 \	Default = 1, set to 0 if you want the filter off entirely (not recommended).")
-required.add_argument("--lsu", help="path to lsu input file")
-required.add_argument("--ssu", help="path to ssu input file")
+required.add_argument("--lsu", help="path to lsu input file (may be gzip or bgzip compressed)")
+required.add_argument("--ssu", help="path to ssu input file (may be gzip or bgzip compressed)")
 optional.add_argument("-o", "--output", default="taxmerge.txt", help="output name/location. Default is taxmerge.txt")
 
 args = parser.parse_args()
@@ -46,7 +48,7 @@ def makecolor(percent):
 
 """Takes the Metaxa2 metaxa.taxonomy.txt output and summarizes results by taxonomic level"""
 def TaxParser(path, rnatype, mode):
-    inf = open(path, "r")
+    inf = openText(path)
     if mode == "w": 
         outf = open(outfile, "w+")
         parseruns = 1
@@ -64,24 +66,10 @@ def TaxParser(path, rnatype, mode):
     for line in inf:
             total+=1
 
-            summary=line.split()
-            newsum = []
-            for item in summary:
-                    if re.search(r"[0-9/]+", item):
-                            pass
-                    else:
-                            newsum.append(item)
-            taxa = ' '.join(newsum)
-            if taxa == '':
+            # Lineage column, without the empty level after the species' trailing ";" (see metaxa2io.py)
+            taxalist = parseLineage(line)
+            if not taxalist:
                     continue
-            taxalist = taxa.split(";")
-
-            # The species (and ONLY species) level also ENDS in ";",
-            # So if a species level exists, then there will be an empty string at the end of our list.
-            # Hence, this removes the last item in our list only if it's an empty string.
-
-            if taxalist[len(taxalist)-1] == '':
-                    del taxalist[len(taxalist)-1]
 
             for i in range(1,len(taxalist)+1):
                     fullname = '.'.join(taxalist[0:i])
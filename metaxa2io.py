@@ -0,0 +1,194 @@
+import re
+import sys
+import time
+
+"""
+Shared reader for Metaxa2 metaxa.taxonomy.txt files, used by metaxa2merge.py, metaxa2color.py and metaxa2stats.py.
+
+Lines are tab-separated columns:
+    MISEQ06:640:000000000-AWW91:1:2114:22959:3582   Eukaryota;Fungi;Ascomycota;   100   150   100
+    read ID                                        lineage                      %id   len   reliability
+so the lineage is just the second column, spaces inside names and all. No per-token regex needed.
+Lines without tabs (e.g. copied out of a terminal) fall back to the old rule of dropping every
+whitespace-separated token with a digit or '/' in it, with a precompiled pattern.
+
+Run this file directly to benchmark the parser against the old tokenizer:
+    python metaxa2io.py [metaxa.taxonomy.txt] [lines]
+"""
+
+numberToken = re.compile(r"[0-9/]")
+
+
+"""Lineage string of a line with no tabs in it: every whitespace token that isn't a number, read ID or N/A"""
+def untabbedLineage(line):
+    return ' '.join(item for item in line.split()[1:] if not numberToken.search(item))
+
+"""
+(read ID, lineage list) of one line. The lineage has no trailing empty level
+(the species level ends in ";"), and is an empty list if the read has no classification.
+"""
+def parseRecord(line):
+    fields = line.split("\t", 2)
+    if len(fields) > 1:
+        taxa = fields[1].strip()
+    else:
+        taxa = untabbedLineage(line)
+    readId = fields[0].split(None, 1)[0] if fields[0].strip() else ""
+    return readId, splitLineage(taxa)
+
+"""
+Just the (stripped) lineage column of one line, not split into levels yet: the key reads are counted
+under before each distinct lineage is split once (splitLineage gives the same list parseLineage would)
+"""
+def lineageText(line):
+    fields = line.split("\t", 2)
+    if len(fields) > 1:
+        return fields[1].strip()
+    return untabbedLineage(line)
+
+"""Lineage list out of the (stripped) lineage column"""
+def splitLineage(taxa):
+    if taxa == "":
+        return []
+    taxalist = taxa.split(";")
+    if taxalist[-1] == "":
+        del taxalist[-1]
+    return taxalist
+
+def parseLineage(line):
+    return parseRecord(line)[1]
+
+
+"""
+Number of reads with each lineage in a Metaxa2 file, counted with NumPy a chunk of the file at a time
+instead of a Python loop over the lines. stream is a binary file object (e.g. from compressedio.openBinary).
+
+Each chunk is one uint8 array. The lineage column of every line is found from the positions of the
+newlines and tabs (searchsorted of the line starts into the tab positions), the columns are copied into
+a fixed-width bytes array, and np.unique counts the distinct ones. Only the distinct lineages (thousands,
+against millions of lines) are decoded and split in Python. Lines without tabs are passed whole, marked,
+and parsed like parseRecord does.
+
+Returns (number of lines, {lineage tuple: reads}), with the lineages in the order they first appear in
+the file, and the same lineages and counts as parseLineage on every line would give.
+"""
+def countLineagesNumpy(stream, chunkBytes=1 << 23):
+    import numpy as np
+    total = 0
+    counts = dict()
+    rest = b""
+    while True:
+        data = stream.read(chunkBytes)
+        chunk = rest + data
+        if not data:
+            rest = b""
+        else:
+            end = chunk.rfind(b"\n") + 1
+            chunk, rest = chunk[:end], chunk[end:]
+        if chunk:
+            total += countChunk(np, chunk, counts)
+        if not data:
+            return total, counts
+
+# Put in front of every field in the fixed-width array, so no field is empty (NumPy strips trailing NULs)
+tabbedMark = 2
+untabbedMark = 1
+# Most bytes put in one fixed-width array; lines with unusually long fields get split off into smaller ones
+maxMatrixBytes = 1 << 24
+fnvPrime = 0x100000001B3
+
+def countChunk(np, chunk, counts):
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    ends = np.flatnonzero(data == 10)
+    if len(data) and data[-1] != 10:
+        ends = np.append(ends, len(data))    # last line of the file, without a newline
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    tabs = np.append(np.flatnonzero(data == 9), len(data))    # sentinel tab past the end
+    firstTab = np.searchsorted(tabs, starts)
+    hasTab = tabs[firstTab] < ends
+    secondTab = np.minimum(firstTab + 1, len(tabs) - 1)
+    fieldStarts = np.where(hasTab, tabs[firstTab] + 1, starts)
+    lengths = np.where(hasTab, np.minimum(tabs[secondTab], ends), ends) - fieldStarts
+    marks = np.where(hasTab, tabbedMark, untabbedMark).astype(np.uint8)
+    # Every window of the padded chunk, as a (no copy) view: row i is the bytes starting at i
+    longest = max(int(lengths.max()), 1)
+    windows = np.lib.stride_tricks.sliding_window_view(np.concatenate((data, np.zeros(longest, dtype=np.uint8))), longest)
+
+    fields = []
+    pending = [(0, len(starts))]
+    while pending:
+        lo, hi = pending.pop()
+        width = max(int(lengths[lo:hi].max()), 1)
+        if (hi - lo) * width > maxMatrixBytes and hi - lo > 1:
+            mid = (lo + hi) // 2
+            pending += [(lo, mid), (mid, hi)]
+            continue
+        words = (width + 8) // 8
+        matrix = np.zeros((hi - lo, words * 8), dtype=np.uint8)
+        matrix[:, 0] = marks[lo:hi]
+        matrix[:, 1:width + 1] = windows[fieldStarts[lo:hi], :width]
+        matrix[:, 1:width + 1][np.arange(width) >= lengths[lo:hi, None]] = 0
+        # Sorting integers is much faster than sorting byte strings, so the rows are grouped by a 64-bit hash
+        # of their words, and then checked against the first row of their group in case two fields collided.
+        rows = matrix.view(np.uint64)
+        hashes = rows[:, 0].copy()
+        for word in range(1, words):
+            hashes = hashes * np.uint64(fnvPrime) ^ rows[:, word]
+        unique, first, inverse, number = np.unique(hashes, return_index=True, return_inverse=True, return_counts=True)
+        if not (rows == rows[first[inverse.ravel()]]).all():
+            unique, first, number = np.unique(matrix.view("S%d" % (words * 8)).ravel(), return_index=True, return_counts=True)
+        fields += zip((first + lo).tolist(), (matrix[i].tobytes().rstrip(b"\0") for i in first.tolist()), number.tolist())
+    fields.sort()
+    for position, field, count in fields:
+        text = field[1:].decode()
+        if field[0] == tabbedMark:
+            taxalist = tuple(splitLineage(text.strip()))
+        else:
+            taxalist = tuple(splitLineage(untabbedLineage(text)))
+        counts[taxalist] = counts.get(taxalist, 0) + count
+    return len(starts)
+
+
+"""The per-line tokenizing metaxa2merge.py and metaxa2color.py used to do, kept only to benchmark against"""
+def legacyLineage(line):
+    summary=line.split()
+    newsum = []
+    for item in summary:
+            if re.search(r"[0-9/]+", item):
+                    pass
+            else:
+                    newsum.append(item)
+    taxa = ' '.join(newsum)
+    if taxa == '':
+            return []
+    taxalist = taxa.split(";")
+    if taxalist[len(taxalist)-1] == '':
+            del taxalist[len(taxalist)-1]
+    return taxalist
+
+def benchmark(lines, parse, repeats=3):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(lines) / best
+
+if __name__ == "__main__":
+    nlines = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r") as inf:
+            lines = [line for i, line in zip(range(nlines), inf)]
+    else:
+        examples = ["MISEQ06:640:000000000-AWW91:1:2114:22959:3582\tEukaryota;Fungi;Ascomycota;Saccharomycetes;Saccharomycetales;Saccharomycetaceae;Saccharomyces;Saccharomyces cerevisiae;\t100\t150\t100\n",
+                    "MISEQ06:640:000000000-AWW91:1:2108:13127:26069\tChloroplast;Unknown Eukaryote\tN/A\tN/A\tN/A\n",
+                    "MISEQ06:640:000000000-AWW91:1:2101:10432:15871\tBacteria;Proteobacteria;Alphaproteobacteria;SAR11 clade\t97.5\t148\t80\n"]
+        lines = [examples[i % len(examples)] for i in range(nlines)]
+    old = benchmark(lines, legacyLineage)
+    new = benchmark(lines, parseLineage)
+    print("%d lines" % len(lines))
+    print("old tokenizer: %d lines/sec" % old)
+    print("metaxa2io:     %d lines/sec (%.1fx)" % (new, new / old))
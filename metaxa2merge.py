@@ -1,6 +1,12 @@
 import argparse
 import sys
-import re
+import os
+
+from taxtrie import TaxTrie
+from taxcache import TaxCache
+from metaxa2io import parseLineage, lineageText, splitLineage
+from compressedio import openText
+from samplematrix import runBatch, writeMatrix
 
 parser = argparse.ArgumentParser(description='Takes both lsu and ssu metaxa runs of the same dataset and merges results. If just one of the two provided it will still report its stats.')
 required = parser.add_argument_group('required arguments')
@@ -10,76 +16,77 @@ optional.add_argument("--filter", type=float, default=1, help="If a particular t
 \	less than this percent of the total reads, iit doesn't report that classification in the results.\
 \	Exception for the Domain level, which will always be reported. \
 \	Default = 1, set to 0 if you want the filter off entirely (not recommended).")
-required.add_argument("--lsu", help="path to lsu input file")
-required.add_argument("--ssu", help="path to ssu input file")
+required.add_argument("--lsu", help="path to lsu input file (may be gzip or bgzip compressed)")
+required.add_argument("--ssu", help="path to ssu input file (may be gzip or bgzip compressed)")
 optional.add_argument("-o", "--output", default="taxmerge.txt", help="output name/location. Default is taxmerge.txt")
+optional.add_argument("--counts", help="Also write the raw counts as a binary table to this directory \
+\	(NumPy .npy files that can be memory-mapped and combined across samples, see taxcounts.py). Requires NumPy.")
+optional.add_argument("--consensus", action="store_true", help="Instead of merging LSU and SSU counts by name, \
+\	join the two files by read ID and count every read once, under the lineage LSU and SSU agree on (see consensusMerge).")
+optional.add_argument("--cache", help="Directory to cache parsed counts in. Re-running on the same inputs \
+\	(e.g. to change --filter) then skips parsing. Entries are keyed by the input's contents.")
+optional.add_argument("--cachesize", type=float, default=1024, help="Size limit of the --cache directory in MB; \
+\	least recently used entries are removed past it. Default 1024.")
+optional.add_argument("--batch", help="Batch mode: directory of Metaxa2 runs of many samples, paired up by name \
+\	(<sample><lsusuffix> and <sample><ssusuffix>, optionally .gz/.bgz compressed). Each sample gets its own report, <output base>.<sample>.txt, \
+\	and the counts of every sample go in one <output base>.project.txt table. --counts then gets one subdirectory per sample.")
+optional.add_argument("--lsusuffix", default="_lsu.taxonomy.txt", help="File name ending of the lsu runs in --batch. Default _lsu.taxonomy.txt")
+optional.add_argument("--ssusuffix", default="_ssu.taxonomy.txt", help="File name ending of the ssu runs in --batch. Default _ssu.taxonomy.txt")
+optional.add_argument("--threads", type=int, default=1, help="Number of samples processed at once in --batch. Default 1.")
+optional.add_argument("--engine", default="twophase", choices=["twophase", "legacy"], help="How reads are counted: 'twophase' (default) counts the reads \
+\	of each distinct lineage first, then adds each lineage to the counts once, weighted by its reads. 'legacy' adds every read's lineage \
+\	as it comes, for comparison. Both give the same results.")
 
-args = parser.parse_args()
-lsupath = args.lsu
-ssupath = args.ssu
-outfile = args.output
-filter = args.filter
-
-
-"""Takes the Metaxa2 metaxa.taxonomy.txt output and summarizes results by taxonomic level"""
-def TaxParser(path, rnatype, mode):
-    inf = open(path, "r")
-    if mode == "w": 
-        outf = open(outfile, "w+")
-        parseruns = 1
-    elif mode == "a":
-        outf = open(outfile, "a+")
-    else:
-        print("mode must be 'w' or 'a'!")
-        sys.exit(0)
+# Bump when the way reads are counted changes, so cached counts from before aren't reused.
+cacheNamespace = "metaxa2merge-1"
 
-    rna = rnatype.upper()
 
+"""
+Every level of the lineage is counted, from the domain down (see taxtrie.py), reads times.
+A read that is just "Eukaryota" is also counted as an "Unknown Eukaryote" one level down.
+"""
+def countLineage(trie, taxalist, reads=1):
+    if taxalist == ["Eukaryota"]:
+        taxalist = ["Eukaryota", "Unknown Eukaryote"]
+    trie.add(taxalist, reads)
+
+
+"""
+Counts every taxonomic level of a Metaxa2 metaxa.taxonomy.txt file. Returns the count trie and the number of reads.
+The twophase engine only counts the reads of each distinct lineage column while reading the file,
+and splits and adds each distinct lineage once at the end. legacy splits and adds every read's lineage.
+"""
+def countTaxonomy(path, engine="twophase"):
+    inf = openText(path)
     total = 0
-    categories = dict()
+    trie = TaxTrie()
+
+    if engine == "legacy":
+        for line in inf:
+                total+=1
+                taxalist = parseLineage(line)
+                if taxalist:
+                        countLineage(trie, taxalist)
+    else:
+        lineages = dict()
+        for line in inf:
+                total+=1
+                taxa = lineageText(line)
+                lineages[taxa] = lineages.get(taxa, 0) + 1
+        for taxa, reads in lineages.items():
+                taxalist = splitLineage(taxa)
+                if taxalist:
+                        countLineage(trie, taxalist, reads)
+    inf.close()
+    return trie, total
 
-    for line in inf:
-            total+=1
-
-            summary=line.split()
-            newsum = []
-            for item in summary:
-                    if re.search(r"[0-9/]+", item):
-                            pass
-                    else:
-                            newsum.append(item)
-            taxa = ' '.join(newsum)
-            if taxa == '':
-                    continue
-            taxalist = taxa.split(";")
-
-            # The species (and ONLY species) level also ENDS in ";",
-            # So if a species level exists, then there will be an empty string at the end of our list.
-            # Hence, this removes the last item in our list only if it's an empty string.
-
-            if taxalist[len(taxalist)-1] == '':
-                    del taxalist[len(taxalist)-1]
-
-            for i in range(1,len(taxalist)+1):
-                    fullname = '.'.join(taxalist[0:i])
-                    levelname = taxalist[i-1]
-                    if fullname not in categories:
-                            categories[fullname] = [1, levelname]
-                    else:
-                            categories[fullname][0] += 1
-            if taxalist[0] == "Eukaryota":
-                try:
-                    test = taxalist[1]
-                except:
-                    if "Eukaryota.Unknown Eukaryote" not in categories:
-                        categories["Eukaryota.Unknown Eukaryote"] = [1, "Unknown Eukaryote"]
-                    else:
-                        categories["Eukaryota.Unknown Eukaryote"][0] += 1
-                            
 
+"""Writes the summary of one set of counts, one line per category, indented by taxonomic level"""
+def writeCategories(outf, label, trie, total, filter):
+    categories = trie.categories(".")
     sortedcategories=sorted(categories)
 
-    outf.write("\nTotal " + rna + " rRNA: " + str(total) + "\n")
+    outf.write("\nTotal " + label + ": " + str(total) + "\n")
     for category in sortedcategories:
             tabs = category.count('.')
             number = categories[category][0]
@@ -90,31 +97,42 @@ def TaxParser(path, rnatype, mode):
                     outf.write("    "*tabs + name + ": " + str(number) + " (" + str(percentage) + "%)\n")
             
     outf.write("\n" + "-"*50 + "\n")
-    if rna == "LSU":
-        global lsuCategories
-        global lsuTotal
-        lsuCategories = categories
-        lsuTotal = total
-    if rna == "SSU":
-        global ssuCategories
-        global ssuTotal
-        ssuCategories = categories
-        ssuTotal = total
-    inf.close()
-    outf.close()
-  
+    return categories
+
+
+"""
+Takes the Metaxa2 metaxa.taxonomy.txt output and summarizes results by taxonomic level.
+Returns the count trie, the number of reads and the categories (see taxtrie.py).
+"""
+def TaxParser(path, rnatype, outf, filter, cache=None, engine="twophase"):
+    rna = rnatype.upper()
+
+    counted = None
+    if cache:
+        counted = cache.get(path, cacheNamespace)
+    if counted is None:
+        counted = countTaxonomy(path, engine)
+        if cache:
+            cache.put(path, cacheNamespace, counted)
+    else:
+        print("using cached counts for " + path)
+    trie, total = counted
+
+    categories = writeCategories(outf, rna + " rRNA", trie, total, filter)
+    return trie, total, categories
 
 
 """Takes the results of lsu and ssu parsing and merges them, where possible"""
-def rRNA_Merge(reportfilter):
-    outf = open(outfile, "a+")
+def rRNA_Merge(outf, lsu, ssu, reportfilter):
+    lsuTrie, lsuTotal, lsuCategories = lsu
+    ssuTrie, ssuTotal, ssuCategories = ssu
     mergedTotal = lsuTotal + ssuTotal
     outf.write("\nTotal rRNA: " + str(mergedTotal) + "\n")
     rfil = reportfilter
     includefilter = 0.01
     
-    global mergedPiedict
     mergedPiedict = dict()
+    mergedCounts = dict()
 
     sortedLSU = sorted(lsuCategories)
     sortedSSU = sorted(ssuCategories)
@@ -151,24 +169,198 @@ def rRNA_Merge(reportfilter):
                     outf.write("    "*tabs + lname + ": " + str(mergednumber) + " (" + str(mergedpct) + "%)\n")
                 
                 mergedPiedict[litem] = [lname, mergedpct]
+                mergedCounts[litem] = mergednumber
             if match == True:
                 break
-    outf.close()                
+    return mergedCounts, mergedPiedict
 
 
-"""Function manually called to do all the reporting work"""
-def main_results(lsupath, ssupath, filter):
+"""
+Lineage LSU and SSU agree on for one read: if one lineage just goes deeper than the other, the deeper one,
+otherwise the levels they share. Reads whose LSU and SSU lineages don't even share a domain are
+counted as "Conflicting LSU/SSU".
+"""
+def consensusLineage(lsulist, ssulist):
+    shared = 0
+    for lname, sname in zip(lsulist, ssulist):
+        if lname != sname:
+            break
+        shared += 1
+    if shared == min(len(lsulist), len(ssulist)):
+        return lsulist if len(lsulist) >= len(ssulist) else ssulist
+    if shared == 0:
+        return ["Conflicting LSU/SSU"]
+    return lsulist[0:shared]
+
+"""Key a read is joined on: its packed Illumina read ID (see readid.py), or the raw ID if it isn't one"""
+def readKey(codec, line):
+    id = line.split(None, 1)[0]
+    try:
+        code, key = codec.encode(id)
+    except ValueError:
+        return id
+    return (code << 64) | key
+
+"""
+Joins LSU and SSU by read ID, so a read classified by both is counted once (the merge above counts it twice).
+The smaller file is loaded into a dict of read key -> lineage; the larger one is then streamed past it,
+taking matched reads out of the dict as it goes. Whatever is left in the dict at the end was only in the smaller file.
+Reads with the same lineage share one tuple, so memory is about one key and one pointer per read of the smaller file.
+With the twophase engine, the consensus lineages are counted per distinct lineage and added to the trie once each at the end.
+"""
+def consensusMerge(outf, lsupath, ssupath, filter, engine="twophase"):
+    lsuIsSmall = os.path.getsize(lsupath) <= os.path.getsize(ssupath)
+    smallpath, largepath = (lsupath, ssupath) if lsuIsSmall else (ssupath, lsupath)
+    from readid import ReadIdCodec    # NumPy is only needed for --consensus
+    codec = ReadIdCodec()
+    lineages = dict()
+    index = dict()
+    inf = openText(smallpath)
+    for line in inf:
+        if not line.strip():
+            continue
+        taxalist = tuple(parseLineage(line))
+        index[readKey(codec, line)] = lineages.setdefault(taxalist, taxalist)
+    inf.close()
+
+    consensusTrie = TaxTrie()
+    consensusTotal = 0
+    both = 0
+    consensusCounts = dict()
+    inf = openText(largepath)
+    for line in inf:
+        if not line.strip():
+            continue
+        consensusTotal += 1
+        taxalist = parseLineage(line)
+        smalllist = index.pop(readKey(codec, line), None)
+        if smalllist is not None:
+            both += 1
+            if lsuIsSmall:
+                taxalist = consensusLineage(list(smalllist), taxalist)
+            else:
+                taxalist = consensusLineage(taxalist, list(smalllist))
+        if not taxalist:
+            continue
+        if engine == "legacy":
+            countLineage(consensusTrie, taxalist)
+        else:
+            taxalist = tuple(taxalist)
+            consensusCounts[taxalist] = consensusCounts.get(taxalist, 0) + 1
+    inf.close()
+    for taxalist in index.values():
+        consensusTotal += 1
+        if not taxalist:
+            continue
+        if engine == "legacy":
+            countLineage(consensusTrie, list(taxalist))
+        else:
+            consensusCounts[taxalist] = consensusCounts.get(taxalist, 0) + 1
+    for taxalist, reads in consensusCounts.items():
+        countLineage(consensusTrie, list(taxalist), reads)
+
+    outf.write("\nReads classified by both LSU and SSU: " + str(both) + "\n")
+    writeCategories(outf, "rRNA (one consensus lineage per read)", consensusTrie, consensusTotal, filter)
+    return consensusTrie, consensusTotal
+
+
+"""
+Does all the reporting work for one sample: the lsu and ssu reports, then the merge (or consensus join) of the two,
+written to outfile (replacing it, or added to its end if append). Either path can be None. Returns ({rna: {lineage tuple: count}}, {rna: total reads}) of whatever was parsed.
+"""
+def processSample(lsupath, ssupath, outfile, filter, consensus=False, cache=None, engine="twophase", append=False):
+    outf = open(outfile, "a+" if append else "w+")
+    tables = dict()
+    totals = dict()
     if lsupath:
         print("lsu provided, summarizing results...")
-        TaxParser(lsupath, "lsu", "w")
+        lsu = TaxParser(lsupath, "lsu", outf, filter, cache, engine)
+        tables["LSU"] = dict((lineage, node.count) for lineage, node in lsu[0].walk())
+        totals["LSU"] = lsu[1]
     if ssupath:
         print("ssu provided, summarizing reuslts...")
-        TaxParser(ssupath, "ssu", "a")
-    if lsupath and ssupath:
+        ssu = TaxParser(ssupath, "ssu", outf, filter, cache, engine)
+        tables["SSU"] = dict((lineage, node.count) for lineage, node in ssu[0].walk())
+        totals["SSU"] = ssu[1]
+    if lsupath and ssupath and consensus:
+        print("joining lsu and ssu reads...")
+        consensusTrie, consensusTotal = consensusMerge(outf, lsupath, ssupath, filter, engine)
+        tables["consensus"] = dict((lineage, node.count) for lineage, node in consensusTrie.walk())
+        totals["consensus"] = consensusTotal
+    elif lsupath and ssupath:
         print("merging lsu and ssu...")
-        rRNA_Merge(filter)
+        mergedCounts, mergedPiedict = rRNA_Merge(outf, lsu, ssu, filter)
+        lineages = dict(('.'.join(lineage), lineage) for lineage in tables["LSU"])
+        tables["merged"] = dict((lineages[litem], mergedCounts[litem]) for litem in mergedCounts)
+        totals["merged"] = lsu[1] + ssu[1]
+    outf.close()
+    return tables, totals
+
+"""Writes the counts of whatever was parsed as a binary table (see taxcounts.py)"""
+def writeCountTable(path, tables, totals):
+    from taxcounts import writeCounts    # NumPy is only needed for this output
+    writeCounts(path, tables, totals)
+
+
+"""Function manually called to do all the reporting work"""
+def main_results(lsupath, ssupath, filter, outfile="taxmerge.txt", consensus=False, countsdir=None, cache=None, engine="twophase"):
+    # An ssu-only run has always added its report to the end of an existing output (e.g. one of an earlier lsu-only run)
+    tables, totals = processSample(lsupath, ssupath, outfile, filter, consensus, cache, engine, append=not lsupath)
+    if countsdir:
+        print("writing count table...")
+        writeCountTable(countsdir, tables, totals)
+    print("Done!")
+
+
+###
+# Batch mode. LSU and SSU runs in one directory are paired up by their file names, and the samples are
+# spread over a pool of worker processes, each writing its own report. The counts come back to the
+# main process and go into one project-wide table (see samplematrix.py).
+###
+
+compressedSuffixes = ["", ".gz", ".bgz"]
+
+"""[(sample, lsu path or None, ssu path or None)] of the runs in a directory, sorted by sample name"""
+def findPairs(directory, lsusuffix, ssusuffix):
+    pairs = dict()
+    for name in sorted(os.listdir(directory)):
+        for rna, suffix in [(0, lsusuffix), (1, ssusuffix)]:
+            for compressed in compressedSuffixes:
+                if name.endswith(suffix + compressed) and len(name) > len(suffix + compressed):
+                    sample = name[:-len(suffix + compressed)]
+                    paths = pairs.setdefault(sample, [None, None])
+                    if paths[rna] is not None:
+                        print("Two %s runs for sample %s: %s and %s" % (("lsu", "ssu")[rna], sample, paths[rna], name))
+                        sys.exit(1)
+                    paths[rna] = os.path.join(directory, name)
+    return [(sample, paths[0], paths[1]) for sample, paths in sorted(pairs.items())]
+
+"""processSample for one pair of a batch (a job of samplematrix.runBatch), plus its count table if asked for"""
+def processPair(job):
+    sample, lsupath, ssupath, outbase, filter, consensus, countsdir, cache, engine = job
+    tables, totals = processSample(lsupath, ssupath, outbase + "." + sample + ".txt", filter, consensus, cache, engine)
+    if countsdir:
+        writeCountTable(os.path.join(countsdir, sample), tables, totals)
+    return sample, tables, totals
+
+def main_batch(directory, outfile, filter, lsusuffix, ssusuffix, consensus=False, countsdir=None, threads=1, cache=None, engine="twophase"):
+    outbase = outfile[:-len(".txt")] if outfile.endswith(".txt") else outfile
+    pairs = findPairs(directory, lsusuffix, ssusuffix)
+    if not pairs:
+        print("No files ending in %s or %s in %s!" % (lsusuffix, ssusuffix, directory))
+        sys.exit(1)
+    jobs = [(sample, lsupath, ssupath, outbase, filter, consensus, countsdir, cache, engine) for sample, lsupath, ssupath in pairs]
+    samples, sampleTables, sampleTotals = runBatch(processPair, jobs, threads)
+    writeMatrix(outbase + ".project.txt", samples, sampleTables, sampleTotals)
     print("Done!")
 
 if __name__ == "__main__":
-    main_results(lsupath, ssupath, filter)
+    args = parser.parse_args()
+    cache = None
+    if args.cache:
+        cache = TaxCache(args.cache, int(args.cachesize * 1024 * 1024))
+    if args.batch:
+        main_batch(args.batch, args.output, args.filter, args.lsusuffix, args.ssusuffix, args.consensus, args.counts, args.threads, cache, args.engine)
+    else:
+        main_results(args.lsu, args.ssu, args.filter, args.output, args.consensus, args.counts, cache, args.engine)
     exit(0)
@@ -1,178 +1,227 @@
 import argparse
 import sys
 
+from metaxa2io import parseLineage
+from compressedio import openText, openBinary
+
 parser = argparse.ArgumentParser(description='more nuanced breakdown of metaxa stats.\n')
 required = parser.add_argument_group('required arguments')
 optional = parser.add_argument_group('optional arguments')
 
-required.add_argument("--taxlevel", type=int, default=2, help="Pick a taxonomic level from 1 (kingdom) to 7 (species). Must be an integer. Defaults to 2 (Phylum). Domain and Kingdom always reported, so both 0 and 1 turn this off.")
+required.add_argument("--taxlevel", default="2", help="Pick a taxonomic level from 1 (kingdom) to 7 (species). Defaults to 2 (Phylum). Domain and Kingdom always reported, so both 0 and 1 turn this off.\
+  Several levels can be given separated by commas (e.g. 2,3,6), or 'all' for 2 to 7: they're all counted in one pass over the input, and each level's report is written to the output one after the other.")
 optional.add_argument("--filter", type=float, default=0.1, help="If a particular taxonomic classification makes up less than a given percent of the total reads, it doesn't show up in the results.\
   A decimal value (<1) is recommended, as this option is primarily designed to remove misclassified reads that clutter the output. Default = 0.2, set to 0 if you want the filter off entirely.")
-required.add_argument("-i", "--input", help="path to input file")
+required.add_argument("-i", "--input", help="path to input file (may be gzip or bgzip compressed)")
 optional.add_argument("-o", "--output", default="taxstats.txt", help="output name/location\nDefault is taxstats.txt")
 required.add_argument("--rna", default="lsu", help="rRNA type; ssu or lsu")
+optional.add_argument("--counts", help="Also write the domain, kingdom and --taxlevel counts as a binary table to this directory.\
+  Lineages are stored as domain;kingdom and domain;kingdom;<taxlevel name> (see taxcounts.py). With several tax levels, each level gets its own rRNA type\
+  in the table, e.g. LSU.Phylum. Requires NumPy.")
+optional.add_argument("--engine", default="python", choices=["python", "numpy"], help="How the input is counted: line by line in Python (default),\
+  or with NumPy a chunk of the file at a time, which is much faster on large files. Both give the same report. numpy requires NumPy.")
 
-args = parser.parse_args()
-
-infile = args.input
-outfile = args.output
-level = args.taxlevel
-filter = args.filter
-rna = args.rna
-
-
-try:
-		L = int(level)
-except:
-		print("You must input a tax level! See help info ('metaxa2stats.py -h') for details")
-		sys.exit(0)
-if level not in range (0,8):
-		print("Tax level must be between 0 and 7!")
-		sys.exit(0)
-
-if rna != "lsu" and rna != "ssu":
-		print('rRNA type must be "ssu" or "lsu"!')
-		sys.exit(0)
-rna=rna.upper()
-
-
-if level == 2:
-	tclass = "Phylum"
-if level == 3:
-	tclass = "Class"
-if level == 4:
-	tclass = "Order"
-if level == 5:
-	tclass = "Family"
-if level == 6:
-	tclass = "Genus"
-if level == 7:
-	tclass = "Species"
-
-
-inf = open(infile, "r")
-total = 0
-categories = dict()
-
-for line in inf:
-	total+=1
-
-	###
-	#Break down line by whitespace, then only look at the 1st and SOMETIMES 2nd index to get an array with taxonomic info
-        #
-        #This is because lines normally look like this:
-        #MISEQ06:640:000000000-AWW91:1:2114:22959:3582   Chloroplast;;;;;        100     150     100
-        #With all of the taxonomic information in the second column, with levels broken down by ";"
-        #But sometimes they put spaces within the taxonomic information like this:
-        #MISEQ06:640:000000000-AWW91:1:2108:13127:26069  Chloroplast;Unknown Eukaryote   N/A      N/A    N/A
-        #So I check to see if the third column is only letters, and if it is I merge it with the second before splitting by ";"
-	###
-
-	summary=line.split()
-	taxa=summary[1].split(';')
-	if summary[2].isalpha() == True:
-		fulltaxa=summary[1]+summary[2]
-		taxa=fulltaxa.split(';')
-	else:
-		taxa=summary[1].split(';')
-
-	###
-	#Label the read's domain, kingdom, and input taxlevel for counting.
-        #
-        #If encounters just "Mitochondria", list will be ['Mitochondria'], with no other classification
-        #In these cases I want to set the other taxonomic levels to "Unknown".
-        #Hence the try/except statement: If I look for an index that doesn't exist, write that level as "Unknown".
-        #
-        #However, some are entered as "Mitochondria;;;;", resulting in a list of ['Mitochondia','','','','']
-        #I also want to set the other tax levels to "Unknown" in this case, but the indexes DO exist here, they're just empty
-        #Hence the if/else in the try statement: if the index exists but the string inside it is empty, write as "Unknown"
-        #
-        #Dots added so that we can concatenate levels to count 
-        #(want to count "Mitochondria.Unknown" and "Chloroplast.Unknown" separately)
-        #And then have something to split by when returning/printing later
-        #(I.e. be able to easily turn "Mitochondria.Unknown" back into "Unknown" when reporting)
-	###
-
-	domain=taxa[0]
+tclasses = {2: "Phylum", 3: "Class", 4: "Order", 5: "Family", 6: "Genus", 7: "Species"}
+
+
+###
+#Parses --taxlevel: one level, a comma separated list of them, or "all". Returns the levels as a sorted list of ints, or None if it doesn't parse.
+###
+
+def parselevels(taxlevel):
+	if taxlevel.strip().lower() == "all":
+		return sorted(tclasses)
 	try:
-		if not taxa[1]:
-			kingdom=".Unknown"
-		else:
-			kingdom="."+taxa[1]
+		levels = sorted(set(int(item) for item in taxlevel.split(",")))
 	except:
-		kingdom=".Unknown"
+		return None
+	return levels
 
-	try:
-		if level not in range (2,8):
-			pass
-		elif not taxa[level]:
-			family=".Unknown"
+
+###
+#Counting, in two steps. First the reads of each distinct lineage are counted in one pass over the input,
+#either line by line in Python (--engine python) or a chunk at a time with NumPy (--engine numpy, see metaxa2io.countLineagesNumpy).
+#Both give {lineage tuple: reads}, in the order the lineages first appear, so the reports come out the same.
+###
+
+def countlineages(inf):
+	total = 0
+	lineages = dict()
+	for line in inf:
+		total+=1
+
+		###
+		#Get the lineage as a list of levels, split by ";"
+	        #
+	        #Lines look like this:
+	        #MISEQ06:640:000000000-AWW91:1:2114:22959:3582   Chloroplast;;;;;        100     150     100
+	        #With all of the taxonomic information in the second (tab-separated) column, with levels broken down by ";"
+	        #Names can have spaces in them, like this:
+	        #MISEQ06:640:000000000-AWW91:1:2108:13127:26069  Chloroplast;Unknown Eukaryote   N/A      N/A    N/A
+	        #metaxa2io reads that column as a whole, so "Unknown Eukaryote" stays one name.
+	        #Reads with no classification at all are counted as "Unclassified".
+		###
+		taxa=tuple(parseLineage(line))
+		lineages[taxa] = lineages.get(taxa, 0) + 1
+	return total, lineages
+
+def countlineagesnumpy(infile):
+	from metaxa2io import countLineagesNumpy
+	inf = openBinary(infile)
+	total, lineages = countLineagesNumpy(inf)
+	inf.close()
+	return total, lineages
+
+
+###
+#Then each distinct lineage adds its number of reads to the domain, the kingdom and every requested level.
+#Counts are kept in a rank-indexed structure of dicts keyed by tuples, no string building per read:
+#    domains[(domain,)]                          reads in each domain
+#    kingdoms[(domain, kingdom)]                 reads in each kingdom of each domain
+#    ranks[level][(domain, kingdom, name)]       reads with that name at that level, per level asked for
+###
+
+def countlevels(lineages, levels):
+	domains = dict()
+	kingdoms = dict()
+	ranks = dict((level, dict()) for level in levels if level in range(2,8))
+	for taxa, reads in lineages.items():
+		if not taxa:
+			taxa=("Unclassified",)
+
+		###
+		#Label the lineage's domain, kingdom, and input taxlevels for counting.
+	        #
+	        #If encounters just "Mitochondria", list will be ['Mitochondria'], with no other classification
+	        #In these cases I want to set the other taxonomic levels to "Unknown".
+	        #Hence the length checks: If I look for an index that doesn't exist, write that level as "Unknown".
+	        #
+	        #However, some are entered as "Mitochondria;;;;", resulting in a list of ['Mitochondia','','','','']
+	        #I also want to set the other tax levels to "Unknown" in this case, but the indexes DO exist here, they're just empty
+	        #Hence the check for an empty string: if the index exists but the string inside it is empty, write as "Unknown"
+	        #
+	        #Levels are counted under tuple keys, so "Unknown" in Mitochondria and "Unknown" in Chloroplast
+	        #are counted separately, and names with dots in them (e.g. "Saccharomyces sp.") stay whole.
+		###
+		domain=taxa[0]
+		if len(taxa) > 1 and taxa[1]:
+			kingdom=taxa[1]
 		else:
-			family="."+taxa[level]
-	except:
-		family=".Unknown"
+			kingdom="Unknown"
 
-	###
-	#Counting mechanism: dictionary.
-        #Again, dots used to count the "Unknown"s separately, while being able to split back up later
-	###
+		key = (domain,)
+		domains[key] = domains.get(key, 0) + reads
+		key = (domain, kingdom)
+		kingdoms[key] = kingdoms.get(key, 0) + reads
+		for level, counts in ranks.items():
+			if len(taxa) > level and taxa[level]:
+				key = (domain, kingdom, taxa[level])
+			else:
+				key = (domain, kingdom, "Unknown")
+			counts[key] = counts.get(key, 0) + reads
+	return domains, kingdoms, ranks
 
-	if (domain+"..") not in categories: 
-		categories[domain+".."]=[domain," "," ",1]
-	else:
-		categories[domain+".."][3]+=1
-	if (domain+kingdom+".") not in categories:
-		categories[domain+kingdom+"."]=[domain,kingdom," ",1]
-	elif (domain+kingdom+".") != (domain+".."):
-		categories[domain+kingdom+"."][3]+=1
-	if level not in range(2,8):
-		continue
-	if (domain+kingdom+family) not in categories:
-		categories[domain+kingdom+family]=[domain,kingdom,family,1]
-	elif (domain+kingdom+family) != (domain+"..") and (domain+kingdom+family) != (domain+kingdom+"."):
-		categories[domain+kingdom+family][3]+=1
-
-
-outf = open(outfile, "w+")
-if level not in range (2,8):
-	outf.write("\nNo indent: Domain\n\tFirst indent: Kingdom\n\n")
-else:
-	outf.write("\nNo indent: Domain\n\tFirst indent: Kingdom\n\t\tSecond indent: " + tclass + "\n\n")
-outf.write("Total " + rna + " rRNA: " + str(total) + "\n")
-
-###Sort first by domain alphabetically, then by kingdom alphabetically, then by input tax level by frequency from highest to lowest.
-
-sorted_categories=sorted(categories.items(), key=lambda x: (x[1][0],x[1][1],-x[1][3]))
 
 ###
+#Writes the report of one level (the domain and kingdom counts are the same for every level).
+#
+#Sort first by domain alphabetically, then by kingdom alphabetically, then by input tax level by frequency from highest to lowest.
+#Domains sort before their kingdoms, and each kingdom before its own rows of the input level; ties keep the order the names were first seen in.
+#
 #Filter used to remove entries with only a handful of (probably accidental) counts
-#Split by the dots from earlier, then check to see if the entry is classified just by domain, to kingdom, or up to the input level.
 #If input level, tabbed twice. If kingdom, tabbed once. If domain, not tabbed. Gives clear organization in results.
 ###
 
-for category in sorted_categories:
-	name=category[0]
-	number=categories[name][3]
-	percentage = round(float(number*100/total),2)
-	percentagestr = str(percentage)+"%"
-	levelfilter = filter * level
+def writereport(outf, level, rna, total, domains, kingdoms, counts, filter):
+	if level not in range (2,8):
+		outf.write("\nNo indent: Domain\n\tFirst indent: Kingdom\n\n")
+	else:
+		outf.write("\nNo indent: Domain\n\tFirst indent: Kingdom\n\t\tSecond indent: " + tclasses[level] + "\n\n")
+	outf.write("Total " + rna + " rRNA: " + str(total) + "\n")
 
-	if categories[name][2] != " " and level in range (2,8):
-		if "Unknown" in categories[name][1] and "Unknown" in categories[name][2]:
-			continue
-		if percentage < levelfilter:
-			continue
-		else:
-			outf.write("\t\t%s: %s (%s)\n" % (name.split(".")[2], number, percentagestr))
-	elif categories[name][1] != " ":
-		if percentage < filter:
-			continue
+	rows = list(domains.items()) + list(kingdoms.items())
+	if level in range (2,8):
+		rows += list(counts.items())
+	rows.sort(key=lambda x: (x[0][0], len(x[0]) > 1, x[0][1:2], -x[1]))
+
+	levelfilter = filter * level
+	for key, number in rows:
+		percentage = round(float(number*100/total),2)
+		percentagestr = str(percentage)+"%"
+		if len(key) == 3:
+			if "Unknown" in key[1] and "Unknown" in key[2]:
+				continue
+			if percentage < levelfilter:
+				continue
+			else:
+				outf.write("\t\t%s: %s (%s)\n" % (key[2], number, percentagestr))
+		elif len(key) == 2:
+			if percentage < filter:
+				continue
+			else:
+				outf.write("\t%s: %s (%s)\n" % (key[1], number, percentagestr))
 		else:
-			outf.write("\t%s: %s (%s)\n" % (name.split(".")[1], number, percentagestr))
-	else:
-		outf.write("%s: %s (%s)\n" % (name.split(".")[0], number, percentagestr))
-inf.close
-outf.close
+			outf.write("%s: %s (%s)\n" % (key[0], number, percentagestr))
 
-print("Done!")
 
+###
+#Optional binary count table, lineages domain;kingdom;taxlevel. With more than one level, each level is its own rRNA type (e.g. LSU.Phylum).
+###
+
+def writecounttable(countsdir, levels, rna, total, domains, kingdoms, ranks):
+	from taxcounts import writeCounts
+	tables = dict()
+	totals = dict()
+	for level in levels:
+		table = dict(domains)
+		table.update(kingdoms)
+		if level in ranks:
+			table.update(ranks[level])
+		label = rna if len(levels) == 1 else rna + "." + tclasses.get(level, "Kingdom")
+		tables[label] = table
+		totals[label] = total
+	writeCounts(countsdir, tables, totals)
+
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+
+	infile = args.input
+	outfile = args.output
+	levels = parselevels(args.taxlevel)
+	filter = args.filter
+	rna = args.rna
+	countsdir = args.counts
+
+	if levels is None:
+			print("You must input a tax level! See help info ('metaxa2stats.py -h') for details")
+			sys.exit(0)
+	for level in levels:
+		if level not in range (0,8):
+			print("Tax level must be between 0 and 7!")
+			sys.exit(0)
+
+	if rna != "lsu" and rna != "ssu":
+			print('rRNA type must be "ssu" or "lsu"!')
+			sys.exit(0)
+	rna=rna.upper()
+
+	if args.engine == "numpy":
+		total, lineages = countlineagesnumpy(infile)
+	else:
+		inf = openText(infile)
+		total, lineages = countlineages(inf)
+		inf.close()
+	domains, kingdoms, ranks = countlevels(lineages, levels)
+
+	outf = open(outfile, "w+")
+	for i, level in enumerate(levels):
+		if i > 0:
+			outf.write("\n" + "-"*50 + "\n")
+		writereport(outf, level, rna, total, domains, kingdoms, ranks.get(level), filter)
+	outf.close()
+
+	if countsdir:
+		writecounttable(countsdir, levels, rna, total, domains, kingdoms, ranks)
+
+	print("Done!")
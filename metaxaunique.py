@@ -1,78 +1,176 @@
 import sys
+import os
 import argparse
-import operator
+from itertools import islice
 import numpy as np
 
-parser = argparse.ArgumentParser(description='more nuanced breakdown of metaxa stats.\n')
-parser.add_argument("--input1", help="path to first input file")
-parser.add_argument("--input2", help="path to second input file")
-args = parser.parse_args()
-
-in1 = open(args.input1, "r")
-in2 = open(args.input2, "r")
-sort1 = []
-sort2 = []
-
-
-lines1 = []
-lines2 = []
-for line in in1:
-	id = line.split()[0]
-	idparts = id.split(':')
-	lines1.append(idparts)
-for line in in2:
-	id = line.split()[0]
-	idparts = id.split(':')
-	lines2.append(idparts)
-	
-sort1 = sorted(lines1, key=operator.itemgetter(4,5,6))
-sort2 = sorted(lines2, key=operator.itemgetter(4,5,6))
-
-in1.close()
-lines1 = None
-in2.close()
-lines2 = None
-
-
-t2 = len(sort2)
-start = round(t2 / 2)
-moves = 0
-matches = []
-
-
-def binary(line1, list, n):
-	first = 0
-	last = len(list) - 1
-	found = False
-	while first <=last and not found:
-		midpoint = (first + last) // 2
-		#print("midpoint: " + str(midpoint) + "\nfirst: " + str(first) + "\nlast: " + str(last) + "\n")
-		if list[midpoint][n] == line1[n]:
-			found = True
-		else:
-			if line1 < list[midpoint]:
-				last = midpoint - 1
-			else:
-				first = midpoint + 1
-	if not found:
-		return
-	if found and n == 4:
-		binary(line1, list, 5)
-	if found and n == 5:
-		binary(line1, list, 6)
-	if found and n == 6:
-		matches.append(line1)
-	return found
-		
-for value in sort1:
-	binary(value, sort2, 4)
-	
-
-pct1 = round(len(matches) / len(sort1) * 100, 3)
-pct2 = round(len(matches) / len(sort2) * 100, 3)
-print("total in1: " + str(len(sort1)) + "\ntotal in2: " + str(len(sort2)) + "\n")
-print("# matches: " + str(len(matches)) + "\npercent in1: " + str(pct1) + "%\npercent in2: " + str(pct2) + "%\n")
-print("some examples: \n")
-for i in range (0, 20):
-	print(":".join(matches[i]))
-sys.exit(0)
+from readid import ReadIdCodec
+from compressedio import openText
+
+parser = argparse.ArgumentParser(description='Compares the reads of two metaxa runs: how many are in both, and how many only in one of them.\n')
+parser.add_argument("--input1", help="path to first input file (may be gzip or bgzip compressed, or BAM)")
+parser.add_argument("--input2", help="path to second input file (may be gzip or bgzip compressed, or BAM)")
+parser.add_argument("--inputs", nargs="+", help="N-way mode: any number of metaxa .taxonomy.txt or bbmap .sam files. Reports how many reads are in every combination of them (an UpSet table), in one pass")
+parser.add_argument("--names", nargs="+", help="names for the --inputs files in the table, in the same order. Defaults to the file names")
+parser.add_argument("--out", help="optional output base name; if given, the read IDs in both/only input1/only input2 are written to <out>.both.txt, <out>.only1.txt and <out>.only2.txt. In N-way mode, the table is also written to <out>.upset.txt")
+
+
+###
+#Reads are matched on their read ID, packed into integers by readid.ReadIdCodec:
+#the instrument:run:flowcell prefix goes in a small shared dictionary, and lane, tile, x and y in one 64-bit key.
+#Each input becomes a sorted array of unique keys (about 10 bytes a read),
+#and the overlaps are NumPy set operations on those arrays.
+#
+#Two inputs are a hash join: only the smaller file is held as such an array, and the larger one is streamed past it
+#a chunk of lines at a time, each chunk looked up in the small side with a binary search (searchsorted).
+#Memory is the small side plus one chunk, however big the larger file is.
+###
+
+###
+#Only mapped reads of a bbmap .sam count as classified, so records with no reference ('*' in the third column) are skipped.
+#Metaxa2 lines never have '*' as their lineage, so this passes them all through.
+###
+
+def classifiedlines(inf):
+	for line in inf:
+		fields = line.split("\t", 3)
+		if len(fields) > 2 and fields[2] == "*":
+			continue
+		yield line
+
+def encodeinput(codec, path):
+	inf = openText(path)
+	codes, keys = codec.encodeLines(classifiedlines(inf))
+	inf.close()
+	return codes, keys
+
+###
+#The larger input, a chunk of lines at a time, as (codes, keys) of the reads in each chunk
+###
+
+def encodechunks(codec, path, chunklines):
+	inf = openText(path)
+	lines = classifiedlines(inf)
+	chunk = list(islice(lines, chunklines))
+	while chunk:
+		yield codec.encodeLines(chunk)
+		chunk = list(islice(lines, chunklines))
+	inf.close()
+
+def writeids(path, codec, joined):
+	outf = open(path, "w")
+	for id in codec.decodeJoined(joined):
+		outf.write(id + "\n")
+	outf.close()
+
+###
+#A read is counted once per input however many lines it has. Copies of a read in the larger file are merged within a chunk;
+#bbmap writes all the alignments of a read together, and Metaxa2 has one line a read, so copies far apart don't happen in practice
+#(if they did, such a read would be counted again in "only in" the larger file, never in the matches).
+###
+
+def overlap(path1, path2, out=None, examples=20, chunklines=1 << 18):
+	swap = os.path.getsize(path1) > os.path.getsize(path2)
+	small, large = (path2, path1) if swap else (path1, path2)
+	codec = ReadIdCodec()
+	codes, keys = encodeinput(codec, small)
+	smallids = np.unique(codec.joinKeys(codes, keys))
+	codes = keys = None
+
+	matched = np.zeros(len(smallids), dtype=bool)
+	largeonly = 0
+	if out:
+		onlylarge = open(out + (".only1.txt" if swap else ".only2.txt"), "w")
+	for codes, keys in encodechunks(codec, large, chunklines):
+		#Plain keys sort and compare much faster than records, so records are only used once a second prefix turns up
+		if len(codec.prefixList) > 1 and smallids.dtype.names is None:
+			smallids = codec.joinKeys(np.zeros(len(smallids), dtype=np.uint16), smallids, records=True)
+		ids = np.unique(codec.joinKeys(codes, keys))
+		index = np.searchsorted(smallids, ids)
+		found = index < len(smallids)
+		found[found] = smallids[index[found]] == ids[found]
+		matched[index[found]] = True
+		largeonly += len(ids) - int(found.sum())
+		if out:
+			for id in codec.decodeJoined(ids[~found]):
+				onlylarge.write(id + "\n")
+	both = smallids[matched]
+	if out:
+		onlylarge.close()
+		writeids(out + ".both.txt", codec, both)
+		writeids(out + (".only2.txt" if swap else ".only1.txt"), codec, smallids[~matched])
+
+	#Returns (total in1, total in2, in both, only in1, only in2, some matching IDs)
+	smalltotal = len(smallids)
+	nmatch = len(both)
+	smallonly = smalltotal - nmatch
+	largetotal = nmatch + largeonly
+	if swap:
+		return largetotal, smalltotal, nmatch, largeonly, smallonly, codec.decodeJoined(both[:examples])
+	return smalltotal, largetotal, nmatch, smallonly, largeonly, codec.decodeJoined(both[:examples])
+
+
+###
+#N-way mode. Every unique read of every input goes into one array, np.unique groups the copies of each read,
+#and each read gets a bitmask of the inputs it was found in (bit i set = in input i).
+#Counting the masks gives the size of every exact combination at once, instead of running every pair separately.
+###
+
+def upset(paths):
+	if len(paths) > 63:
+		print("At most 63 inputs can be compared at once!")
+		sys.exit(1)
+	codec = ReadIdCodec()
+	encoded = [encodeinput(codec, path) for path in paths]
+	allids = []
+	allbits = []
+	totals = []
+	for i, (codes, keys) in enumerate(encoded):
+		ids = np.unique(codec.joinKeys(codes, keys))
+		totals.append(len(ids))
+		allids.append(ids)
+		allbits.append(np.full(len(ids), 1 << i, dtype=np.uint64))
+	encoded = None
+	reads, inverse = np.unique(np.concatenate(allids), return_inverse=True)
+	masks = np.zeros(len(reads), dtype=np.uint64)
+	np.bitwise_or.at(masks, inverse, np.concatenate(allbits))
+	combos, counts = np.unique(masks, return_counts=True)
+	#Returns the number of unique reads in each input, and [(mask, number of reads in exactly that combination)] largest first
+	table = sorted(zip([int(combo) for combo in combos], [int(count) for count in counts]), key=lambda x: -x[1])
+	return totals, table
+
+def writeupset(outf, names, totals, table):
+	outf.write("\t".join(names) + "\treads\tpercent of all reads\n")
+	allreads = sum(count for mask, count in table)
+	for mask, count in table:
+		inset = ["1" if mask >> i & 1 else "0" for i in range(len(names))]
+		outf.write("\t".join(inset) + "\t" + str(count) + "\t" + str(round(count / allreads * 100, 3)) + "\n")
+	outf.write("\ntotal\t" + "\t".join(str(total) for total in totals) + "\n")
+
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+	if args.inputs:
+		names = args.names or args.inputs
+		if len(names) != len(args.inputs):
+			print("--names needs one name per --inputs file!")
+			sys.exit(1)
+		totals, table = upset(args.inputs)
+		writeupset(sys.stdout, names, totals, table)
+		if args.out:
+			outf = open(args.out + ".upset.txt", "w")
+			writeupset(outf, names, totals, table)
+			outf.close()
+		sys.exit(0)
+
+	total1, total2, nmatch, only1, only2, examplelist = overlap(args.input1, args.input2, args.out)
+
+	pct1 = round(nmatch / total1 * 100, 3)
+	pct2 = round(nmatch / total2 * 100, 3)
+	print("total in1: " + str(total1) + "\ntotal in2: " + str(total2) + "\n")
+	print("# matches: " + str(nmatch) + "\npercent in1: " + str(pct1) + "%\npercent in2: " + str(pct2) + "%\n")
+	print("only in1: " + str(only1) + "\nonly in2: " + str(only2) + "\n")
+	print("some examples: \n")
+	for id in examplelist:
+		print(id)
+	sys.exit(0)
@@ -0,0 +1,55 @@
+from collections import deque
+
+"""
+Aho-Corasick automaton: finds which of any number of substrings occur in a text in one pass over the text,
+however many substrings there are. bbmapparse.py uses it to check every --queries include/exclude string
+against a lineage at once, instead of one `in` test per string.
+"""
+
+
+class PatternAutomaton:
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.goto = [dict()]     # state -> {character: next state}
+        self.fail = [0]          # state -> longest proper suffix that is also a state
+        self.found = [set()]     # state -> indexes of the patterns that end here
+        for i, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                nextState = self.goto[state].get(char)
+                if nextState is None:
+                    nextState = len(self.goto)
+                    self.goto[state][char] = nextState
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.found.append(set())
+                state = nextState
+            self.found[state].add(i)
+
+        # Breadth first, so the fail state of every state is built before the states below it
+        # (states right under the root fail back to the root, which they already do)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nextState in self.goto[state].items():
+                queue.append(nextState)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nextState] = self.goto[fallback].get(char, 0)
+                self.found[nextState] |= self.found[self.fail[nextState]]
+        self.found = [frozenset(found) for found in self.found]
+
+    """Set of the indexes of every pattern that occurs in text"""
+    def search(self, text):
+        goto = self.goto
+        fail = self.fail
+        found = set(self.found[0])    # empty patterns are in every text
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if self.found[state]:
+                found |= self.found[state]
+        return found
@@ -8,7 +8,7 @@ Last modified Aug 16, 2018
 Description: Pipeline for analyzing taxonomy of metagenomic data.
              Steps: Subsample --> mapping --> taxonomic summary --> visualization
              Requires Python 3
-             Python dependencies: krona
+             Krona charts are written by bbmaptax.py, Krona itself is not required
 
 Usage: test.sh [-i <filepath>] [-o <string>] [OPTIONS]
 
@@ -207,20 +207,11 @@ fi
 echo "Generating taxonomic summary..."
 python bbmaptax.py --in ${BBMAPOUT} --out ${OUTBASE} --filter ${FILTER} --krona ${KRONA}
 
-KRONAMERGED=${OUTBASE}.krona.merged.txt
-KRONASSU=${OUTBASE}.krona.ssu.txt
-KRONALSU=${OUTBASE}.krona.lsu.txt
-
 # Visualization step
+# bbmaptax.py writes the krona charts itself (${OUTBASE}.krona.{merged,ssu,lsu}.html), so there's nothing left to do here.
 if [[ ${KRONA} = true ]]
 then
-    echo "Generating krona charts..."
-    ktImportText ${KRONAMERGED} -o ${OUTBASE}.krona.merged.html
-    #/global/projectb/scratch/cmodonog/scripts/makeKrona.sh -i ${KRONAMERGED} -o ${OUTBASE}.krona.merged.html --rrnatype merged
-    ktImportText ${KRONASSU} -o ${OUTBASE}.krona.ssu.html
-    #/global/projectb/scratch/cmodonog/scripts/makeKrona.sh -i ${KRONASSU} -o ${OUTBASE}.krona.ssu.html --rrnatype ssu
-    ktImportText ${KRONALSU} -o ${OUTBASE}.krona.lsu.html
-    #/global/projectb/scratch/cmodonog/scripts/makeKrona.sh -i ${KRONALSU} -o ${OUTBASE}.krona.lsu.html --rrnatype lsu
+    echo "Krona charts generated by bbmaptax.py."
 else
     echo "Krona chart generation will be skipped."
 fi
@@ -0,0 +1,87 @@
+from array import array
+
+import numpy as np
+
+"""
+Compact representation of Illumina read IDs, e.g. MISEQ06:640:000000000-AWW91:1:2114:22959:3582
+(instrument:run:flowcell:lane:tile:x:y).
+
+Within a library the instrument:run:flowcell prefix is the same for (nearly) every read, so it's stored once
+in a small dictionary and each read only keeps its index into it. Lane, tile, x and y are packed into one
+64-bit integer: 8 bits of lane, 16 of tile, 20 each of x and y. A read then costs 10 bytes in two NumPy
+arrays instead of a list of seven strings, and matching reads between files is integer comparison.
+"""
+
+laneShift = 56
+tileShift = 40
+xShift = 20
+fieldMask = (1 << 20) - 1
+
+keyDtype = np.dtype([("prefix", "<u2"), ("key", "<u8")])
+
+
+class ReadIdCodec:
+    def __init__(self):
+        self.prefixes = dict()
+        self.prefixList = []
+
+    def prefixCode(self, prefix):
+        code = self.prefixes.get(prefix)
+        if code is None:
+            code = len(self.prefixList)
+            if code > 0xFFFF:
+                raise ValueError("more than 65536 different instrument:run:flowcell prefixes")
+            self.prefixes[prefix] = code
+            self.prefixList.append(prefix)
+        return code
+
+    """(prefix code, packed lane/tile/x/y) of one read ID. Mate suffixes like /1 are dropped."""
+    def encode(self, readId):
+        parts = readId.split("/", 1)[0].split(":")
+        if len(parts) < 4:
+            raise ValueError("not an Illumina read ID: " + readId)
+        lane, tile, x, y = int(parts[-4]), int(parts[-3]), int(parts[-2]), int(parts[-1])
+        if lane > 0xFF or tile > 0xFFFF or x > fieldMask or y > fieldMask:
+            raise ValueError("read ID coordinates too large to pack: " + readId)
+        key = (lane << laneShift) | (tile << tileShift) | (x << xShift) | y
+        return self.prefixCode(":".join(parts[:-4])), key
+
+    def decode(self, code, key):
+        key = int(key)
+        coords = (key >> laneShift, (key >> tileShift) & 0xFFFF, (key >> xShift) & fieldMask, key & fieldMask)
+        return ":".join([self.prefixList[int(code)]] + [str(coord) for coord in coords])
+
+    """
+    Encodes the read ID (first column) of every line, skipping SAM header lines and empty lines,
+    so it works on Metaxa2 .taxonomy.txt and bbmap .sam files alike. Returns (prefix codes, keys) arrays.
+    """
+    def encodeLines(self, lines):
+        codes = array("H")
+        keys = array("Q")
+        for line in lines:
+            if line.startswith("@") or not line.strip():
+                continue
+            code, key = self.encode(line.split(None, 1)[0])
+            codes.append(code)
+            keys.append(key)
+        return np.frombuffer(codes, dtype=np.uint16), np.frombuffer(keys, dtype=np.uint64)
+
+    """
+    One comparable array out of (codes, keys): just the keys when every read seen shares a prefix,
+    otherwise (prefix, key) records. Arrays meant to be compared must come from the same codec,
+    and should be joined after all of them have been encoded, or with records=True
+    (always records, for arrays joined while more reads are still being encoded).
+    """
+    def joinKeys(self, codes, keys, records=False):
+        if len(self.prefixList) <= 1 and not records:
+            return keys
+        joined = np.empty(len(keys), dtype=keyDtype)
+        joined["prefix"] = codes
+        joined["key"] = keys
+        return joined
+
+    """Read ID strings back out of an array made by joinKeys"""
+    def decodeJoined(self, joined):
+        if joined.dtype == keyDtype:
+            return [self.decode(record["prefix"], record["key"]) for record in joined]
+        return [self.decode(0, key) for key in joined]
@@ -0,0 +1,91 @@
+from collections import OrderedDict
+
+"""
+Memoized classification of bbmap reference names, used by bbmaptax.py.
+
+Reads in a SILVA-mapped .sam hit a bounded set of references, and a reference name like
+'tid|1234|LSU Eukaryota;Fungi;Dikarya' always classifies the same way. So each name is parsed
+(rRNA type, lineage split into its levels) the first time it's seen, and every later read mapped to it
+is one dict lookup. The table is a least-recently-used cache of at most maxSize names,
+and counts its hits and misses so the hit rate can be reported.
+It can also be filled in before counting from the @SQ lines of the .sam header (see samio.headerReferences).
+"""
+
+defaultSize = 1 << 20
+
+
+"""
+(rRNA type, lineage tuple) of a reference name (str or bytes), or None if it isn't an LSU or SSU reference with a taxonomy.
+"""
+def classify(idRegion):
+    if isinstance(idRegion, bytes):
+        if b"tid" not in idRegion:    # taxonomic classifications start with 'tid'. If no classification, it isn't counted.
+            return None
+        idRegion = idRegion.decode()
+    elif "tid" not in idRegion:
+        return None
+    if "LSU" in idRegion:
+        rna = "LSU"
+    elif "SSU" in idRegion:
+        rna = "SSU"
+    else:
+        return None
+    parts=idRegion.split()       # idregion has two parts. the taxid and rRNA type separated by '|'s, then the tax classification separated by ';'s
+    taxa = ' '.join(parts[1:])   # Annoyingly, these parts are separated by spaces even though there are spaces in the tax classification.
+    return (rna, tuple(taxa.split(";")))    # So, need to just remove everything before the first space to get the full tax list.
+
+
+class ReferenceCache:
+    def __init__(self, maxSize=defaultSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()    # raw reference name -> (rna type, lineage tuple) or None, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    """classify(idRegion), from the table if the name has been seen before"""
+    def lookup(self, idRegion):
+        entries = self.entries
+        try:
+            classified = entries[idRegion]
+        except KeyError:
+            self.misses += 1
+            classified = classify(idRegion)
+            self.store(idRegion, classified)
+            return classified
+        self.hits += 1
+        entries.move_to_end(idRegion)
+        return classified
+
+    def store(self, idRegion, classified):
+        self.entries[idRegion] = classified
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    """Classifies reference names ahead of counting (e.g. every @SQ name of the header). Counts as neither hits nor misses."""
+    def preload(self, names):
+        for idRegion in names:
+            if idRegion not in self.entries:
+                self.store(idRegion, classify(idRegion))
+        return self
+
+    """Adds the hit/miss counters of another cache (e.g. of another shard of the same file) into this one"""
+    def mergeStats(self, other):
+        self.hits += other.hits
+        self.misses += other.misses
+        self.evictions += other.evictions
+        return self
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hitRate = round(self.hits / lookups * 100, 2) if lookups else 0
+        return "Reference cache: %d hits, %d misses (%s%% hit rate), %d evicted" % (self.hits, self.misses, hitRate, self.evictions)
+
+    # Only the counters are pickled (with checkpoints, cached counts and shard results): the table is rebuilt as reads come in.
+    def __getstate__(self):
+        return {"maxSize": self.maxSize, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.entries = OrderedDict()
@@ -0,0 +1,96 @@
+import mmap
+import os
+import re
+
+import compressedio
+
+"""
+Byte-level reading of bbmap .sam files, used by bbmaptax.py and bbmapparse.py.
+
+A bbmap run against SILVA writes one @SQ header line per reference before the first read, hundreds of
+thousands of them. Rather than decoding every one of those to str just to see it starts with '@',
+the end of the header is found with one regex scan over the memory-mapped file, and reading starts there.
+Records are then handed out as bytes; callers split out the fields they need and only decode those
+(the reference name, usually), so the sequence and quality columns are never decoded at all.
+"""
+
+# A newline followed by anything but '@', i.e. the end of the header. Searching for the newline
+# first lets the regex engine skip ahead with a fast scan instead of trying a match at every byte.
+headerEndPattern = re.compile(rb"\n[^@]")
+
+# The reference name of an @SQ header line (its SN: field, usually but not necessarily the first one).
+sqNamePattern = re.compile(rb"^@SQ(?:\t[^\t\n]*)*?\tSN:([^\t\n]*)", re.MULTILINE)
+
+
+"""Byte offset of the first line after the header of a .sam file (0 if it has no header). path must be a regular file."""
+def headerEnd(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:1] != b"@":
+                return 0
+            match = headerEndPattern.search(mm)
+            if match is None:
+                return len(mm)
+            return match.start() + 1
+
+"""
+Moves a stream (that can peek, like io.BufferedReader) past the header, looking at it a buffer at a time
+with the same regex instead of a line at a time. For stdin and compressed files, which can't be mapped.
+"""
+def skipHeader(stream):
+    while True:
+        chunk = stream.peek(1 << 16)
+        if not chunk.startswith(b"@"):
+            return
+        match = headerEndPattern.search(chunk)
+        if match is not None:
+            stream.read(match.start() + 1)
+            return
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            stream.readline()
+        else:
+            stream.read(end + 1)
+
+"""
+Lines of a .sam file as bytes, starting after the header. '-' reads stdin, and compressed files
+(gzip, BGZF or BAM, see compressedio.py) are read through a decompressing stream.
+Files can have more header lines further down (e.g. several .sam files cat'ed together),
+so callers should still skip lines starting with b"@".
+threads is the number of threads decompressing BGZF/BAM input.
+"""
+def records(path, threads=None):
+    inf, compressed = compressedio.openDetected(path, threads)
+    with inf:
+        if compressed or compressedio.isStream(path):
+            skipHeader(inf)
+        else:
+            inf.seek(headerEnd(path))
+        yield from inf
+
+"""
+Reference names (bytes, as they appear in the third column of the records) of the @SQ lines of a .sam header.
+Compressed files are read through their header only. stdin and pipes can't be read twice, so they give none.
+"""
+def headerReferences(path):
+    if compressedio.isStream(path):
+        return []
+    inf, compressed = compressedio.openDetected(path)
+    with inf:
+        if compressed:
+            header = []
+            while inf.peek(1)[:1] == b"@":
+                header.append(inf.readline())
+            return sqNamePattern.findall(b"".join(header))
+    end = headerEnd(path)
+    if end == 0:
+        return []
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return sqNamePattern.findall(mm, 0, end)
+
+"""The reference name (third column) of a record, still as bytes. '*' for unmapped reads."""
+def refName(record):
+    return record.split(b"\t", 3)[2]
@@ -0,0 +1,55 @@
+import multiprocessing
+
+"""
+Batch mode plumbing shared by bbmaptax.py --manifest and metaxa2merge.py --batch: samples are processed
+on a pool of worker processes, and their counts come back to the main process for one project-wide
+sample x taxon table.
+
+The table is tab-separated text:
+    rRNA    taxon           <sample 1>  <sample 2>  ...
+    LSU     total reads     ...                         one row per rRNA type (and whatever other totals a script keeps)
+    LSU     Eukaryota       ...
+    LSU     Eukaryota;Fungi ...                         one row per (rRNA type, lineage), levels joined by ';'
+Counts include everything classified below the taxon, same as the reports. A taxon missing from a sample is 0.
+"""
+
+
+"""
+Runs worker(job) for every job on threads processes. Each worker returns (sample, {rna: {lineage: count}}, {rna: total}),
+with lineages as tuples or ';'-joined strings. Returns the samples, tables and totals as three lists, in the order of jobs.
+"""
+def runBatch(worker, jobs, threads):
+    print("Processing %d samples on %d processes..." % (len(jobs), threads))
+    samples = []
+    sampleTables = []
+    sampleTotals = []
+    with multiprocessing.Pool(threads) as pool:
+        for sample, tables, totals in pool.imap(worker, jobs):
+            print(sample + " done.")
+            samples.append(sample)
+            sampleTables.append(tables)
+            sampleTotals.append(totals)
+    return samples, sampleTables, sampleTotals
+
+"""{(rna, ';'-joined lineage): count} of one sample's tables"""
+def flatten(tables):
+    counts = dict()
+    for rna in tables:
+        for lineage, count in tables[rna].items():
+            if not isinstance(lineage, str):
+                lineage = ";".join(lineage)
+            counts[(rna, lineage)] = counts.get((rna, lineage), 0) + count
+    return counts
+
+def writeMatrix(path, samples, sampleTables, sampleTotals):
+    sampleCounts = [flatten(tables) for tables in sampleTables]
+    keys = set()
+    for counts in sampleCounts:
+        keys.update(counts)
+    outf = open(path, "w+")
+    outf.write("rRNA\ttaxon\t" + "\t".join(samples) + "\n")
+    for rna in sorted(set().union(*sampleTotals)):
+        outf.write(rna + "\ttotal reads\t" + "\t".join(str(totals.get(rna, 0)) for totals in sampleTotals) + "\n")
+    for rna, lineage in sorted(keys):
+        outf.write(rna + "\t" + lineage + "\t" + "\t".join(str(counts.get((rna, lineage), 0)) for counts in sampleCounts) + "\n")
+    outf.close()
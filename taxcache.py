@@ -0,0 +1,131 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+from compressedio import isStream
+
+"""
+On-disk cache of parsed counts, so re-running a script on the same input only to change --filter
+or the report/krona formatting doesn't parse the whole input again.
+
+Entries are keyed by a hash of the input's contents. Hashing a big file still means reading it once,
+so the (path, size, mtime, inode) of every input seen is also remembered; as long as those haven't changed,
+the stored content hash is used without reading the file at all.
+Every hit touches the entry, and old entries are dropped least-recently-used first whenever
+the cache grows past maxBytes. The remembered content hashes are dropped along with the last entry
+stored for them, so <cacheDir>/stat/ doesn't outgrow the cache.
+
+Batch mode workers share one cache directory, so files are written to a temporary file of their own and
+renamed into place (readers only ever see whole files), and an entry another process removed in the
+meantime is just a miss.
+Inputs that can only be read once (stdin, pipes) are never cached: hashing them would use them up.
+"""
+
+blockSize = 1 << 20
+
+
+def contentHash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as inf:
+        block = inf.read(blockSize)
+        while block:
+            digest.update(block)
+            block = inf.read(blockSize)
+    return digest.hexdigest()
+
+"""Writes path through a temporary file in the same directory and renames it into place. write(f) writes the contents."""
+def writeAtomically(path, write):
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as outf:
+            write(outf)
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+
+
+class TaxCache:
+    def __init__(self, cacheDir, maxBytes=1 << 30):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        os.makedirs(os.path.join(cacheDir, "stat"), exist_ok=True)
+
+    """Content hash of path, from the stat fast path when the file hasn't changed since it was last hashed"""
+    def inputKey(self, path):
+        st = os.stat(path)
+        statKey = "%s|%d|%d|%d" % (os.path.realpath(path), st.st_size, st.st_mtime_ns, st.st_ino)
+        statPath = os.path.join(self.cacheDir, "stat", hashlib.sha1(statKey.encode()).hexdigest())
+        try:
+            with open(statPath, "r") as statInf:
+                key = statInf.read().strip()
+            if key:
+                return key
+        except FileNotFoundError:
+            pass
+        key = contentHash(path)
+        writeAtomically(statPath, lambda statOutf: statOutf.write((key + "\n").encode()))
+        return key
+
+    """
+    namespace separates what different scripts store for the same input (and should change whenever
+    the way a script counts changes, so old entries stop being used)
+    """
+    def entryPath(self, path, namespace):
+        return os.path.join(self.cacheDir, namespace + "-" + self.inputKey(path) + ".pickle")
+
+    def get(self, path, namespace):
+        if isStream(path):
+            return None
+        entry = self.entryPath(path, namespace)
+        try:
+            with open(entry, "rb") as entryInf:
+                value = pickle.load(entryInf)
+            os.utime(entry)    # mark as recently used
+        except FileNotFoundError:    # never stored, or evicted by another process
+            return None
+        return value
+
+    def put(self, path, namespace, value):
+        if isStream(path):
+            return
+        entry = self.entryPath(path, namespace)
+        writeAtomically(entry, lambda entryOutf: pickle.dump(value, entryOutf))
+        self.evict()
+
+    """Deletes least recently used entries until the cache fits in maxBytes, then the stat files no entry is left for"""
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith(".pickle"):
+                continue
+            entry = os.path.join(self.cacheDir, name)
+            try:
+                st = os.stat(entry)
+            except FileNotFoundError:    # evicted by another process since the listing
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        evicted = 0
+        for mtime, entrySize, entry in entries:
+            if size <= self.maxBytes:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            size -= entrySize
+            evicted += 1
+        keys = set(entry[:-len(".pickle")].rsplit("-", 1)[1] for mtime, entrySize, entry in entries[evicted:])
+        statDir = os.path.join(self.cacheDir, "stat")
+        for name in os.listdir(statDir):
+            statPath = os.path.join(statDir, name)
+            try:
+                with open(statPath, "r") as statInf:
+                    key = statInf.read().strip()
+                if key not in keys:
+                    os.remove(statPath)
+            except FileNotFoundError:    # dropped by another process since the listing
+                pass
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+
+"""
+Binary taxon count tables, for comparing and combining samples without re-parsing the text reports.
+
+A table is a directory of plain NumPy .npy files:
+    lineages.npy    every taxon's full lineage, levels joined by ';', sorted
+    <rna>.npy       int64 counts lined up with lineages.npy, one file per rRNA type (LSU, SSU, merged...)
+    rnatypes.npy    the rRNA types in the table
+    totals.npy      total reads of each rRNA type, lined up with rnatypes.npy
+Each file can be opened with np.load(path, mmap_mode="r"), so reading thousands of tables
+only touches the pages that are actually used.
+"""
+
+
+"""tables is {rna: {lineage tuple or ';'-joined string: count}}, totals is {rna: total reads}"""
+def writeCounts(path, tables, totals):
+    os.makedirs(path, exist_ok=True)
+    keyed = dict()
+    for rna in tables:
+        keyed[rna] = dict()
+        for lineage, count in tables[rna].items():
+            if not isinstance(lineage, str):
+                lineage = ";".join(lineage)
+            keyed[rna][lineage] = keyed[rna].get(lineage, 0) + count
+    lineages = sorted(set().union(*keyed.values()))
+    position = dict((lineage, i) for i, lineage in enumerate(lineages))
+    np.save(os.path.join(path, "lineages.npy"), np.array(lineages, dtype=str))
+    rnatypes = sorted(set(tables) | set(totals))
+    for rna in keyed:
+        counts = np.zeros(len(lineages), dtype=np.int64)
+        for lineage, count in keyed[rna].items():
+            counts[position[lineage]] = count
+        np.save(os.path.join(path, rna + ".npy"), counts)
+    np.save(os.path.join(path, "rnatypes.npy"), np.array(rnatypes, dtype=str))
+    np.save(os.path.join(path, "totals.npy"), np.array([totals.get(rna, 0) for rna in rnatypes], dtype=np.int64))
+
+"""Opens a table written by writeCounts. Returns (lineages, {rna: counts}, {rna: total}); arrays are memory-mapped."""
+def readCounts(path, mmap=True):
+    mode = "r" if mmap else None
+    lineages = np.load(os.path.join(path, "lineages.npy"), mmap_mode=mode)
+    rnatypes = np.load(os.path.join(path, "rnatypes.npy"))
+    totalArray = np.load(os.path.join(path, "totals.npy"))
+    counts = dict()
+    totals = dict()
+    for i, rna in enumerate(rnatypes):
+        rna = str(rna)
+        totals[rna] = int(totalArray[i])
+        countPath = os.path.join(path, rna + ".npy")
+        if os.path.exists(countPath):
+            counts[rna] = np.load(countPath, mmap_mode=mode)
+    return lineages, counts, totals
+
+"""
+Combines the tables of many samples into one sample x lineage matrix per rRNA type.
+Returns (lineages, {rna: int64 array of shape (number of tables, number of lineages)}).
+Lineages are lined up with searchsorted on the sorted union, so no text is parsed.
+"""
+def mergeCounts(paths):
+    tables = [readCounts(path) for path in paths]
+    lineages = np.unique(np.concatenate([np.asarray(table[0]) for table in tables]))
+    rnatypes = sorted(set().union(*[table[1].keys() for table in tables]))
+    matrices = dict((rna, np.zeros((len(tables), len(lineages)), dtype=np.int64)) for rna in rnatypes)
+    for i, (tableLineages, counts, totals) in enumerate(tables):
+        columns = np.searchsorted(lineages, tableLineages)
+        for rna in counts:
+            matrices[rna][i, columns] = counts[rna]
+    return lineages, matrices
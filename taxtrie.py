@@ -0,0 +1,74 @@
+import sys
+
+"""
+Shared counting structure for taxonomic lineages, used by bbmaptax.py and metaxa2merge.py.
+
+Every read used to add one dict entry per prefix of its lineage ("Eukaryota", "Eukaryota;Fungi", ...),
+joining a new string for each prefix. Here each rank is a node holding an integer count and
+a dict of its children, so counting a read is just a walk down its lineage.
+Names are interned, so the many reads sharing a lineage also share the name strings.
+"""
+
+
+class TaxNode:
+    __slots__ = ("name", "count", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.children = dict()
+
+
+class TaxTrie:
+    def __init__(self):
+        self.root = TaxNode("")
+
+    """Counts one lineage (list of names from broadest to most specific), weight times"""
+    def add(self, taxaList, weight=1):
+        children = self.root.children
+        for name in taxaList:
+            node = children.get(name)
+            if node is None:
+                name = sys.intern(name)
+                node = TaxNode(name)
+                children[name] = node
+            node.count += weight
+            children = node.children
+
+    """Adds all the counts of another trie into this one"""
+    def merge(self, other):
+        stack = [(self.root, other.root)]
+        while stack:
+            node, otherNode = stack.pop()
+            for name, otherChild in otherNode.children.items():
+                child = node.children.get(name)
+                if child is None:
+                    child = TaxNode(name)
+                    node.children[name] = child
+                child.count += otherChild.count
+                stack.append((child, otherChild))
+        return self
+
+    """Yields (lineage tuple, node) for every node, parents before their children"""
+    def walk(self):
+        stack = [((), self.root)]
+        while stack:
+            path, node = stack.pop()
+            for name, child in node.children.items():
+                childPath = path + (name,)
+                yield childPath, child
+                stack.append((childPath, child))
+
+    """
+    Flattens the trie into the {fullName: [count, levelName]} dict the reports are written from,
+    with the levels of fullName joined by sep. Only as big as the number of distinct categories.
+    """
+    def categories(self, sep):
+        categories = dict()
+        for path, node in self.walk():
+            fullName = sep.join(path)
+            if fullName not in categories:
+                categories[fullName] = [node.count, node.name]
+            else:
+                categories[fullName][0] += node.count
+        return categories